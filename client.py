@@ -3,89 +3,685 @@ import os
 import tracker
 import peer
 import pieces
+import storage
 import time
 import message
 import socket
-import select
-import struct
+import selectors
 import random
+import argparse
+import heapq
+import itertools
 from bitarray import bitarray
 
-def receive(sock, size=4096):
-    data= b''
-    while True:
-        try:
-            buf = sock.recv(size)
-            if not buf:
-                break
-
-            data += buf
-        except Exception as e:
-            # No more data to receive
-            break
-
-    return data
-
-def receive_msg(sock):
-    data = b''
-    buf = 0
-    recved = 0
-    msg_len = 0
-    while recved < 4:
-        try:
-            buf = sock.recv(4)
-            if not buf:
-                break # No data
-
-            msg_len = struct.unpack('!L', buf)[0]
-            data += buf
-            recved += len(buf)
-        except Exception as e:
-            print(e, 'recved < 4')
-            break
-    
-    recved = 0
-
-    while recved < msg_len:
-        try:
-            buf = sock.recv(msg_len-recved)
-            if not buf:
-                break
-
-            data += buf
-            recved += len(buf)
-        except Exception as e:
-            print(e, 'recved < msg_len')
-            break
-    
-    return data
-
+ENDGAME_DUPLICATES = 1 # extra peers a block is requested from in endgame
 
-    
 class Client():
-    def __init__(self, torrent, compact, port = 6881, seeder = 0):
+    def __init__(self, torrent, compact, port = 6881, seeder = 0, engine = 'select', max_half_open = peer.MAX_HALF_OPEN,
+                 connect_timeout = peer.CONNECT_TIMEOUT, handshake_timeout = peer.HANDSHAKE_TIMEOUT,
+                 preallocate = False, sync = storage.SYNC_CLOSE, sendfile = False, read_cache = pieces.READ_CACHE_BUDGET,
+                 recheck = False, files = None, stream = False, unchoke_slots = peer.UNCHOKE_SLOTS,
+                 limits = None, hashers = None, buffers = None, cache = None, writer = None, open_files = None):
         self.tracker = tracker.Tracker(torrent, compact, port)
-        self.peers_manager = peer.PeerList(self.tracker.torrent_num_pieces)
+        self.peers_manager = peer.PeerList(self.tracker.torrent_num_pieces, limits)
         self.pieces = pieces.FileDownloader(self.tracker.torrent_name, self.tracker.torrent_length,
                                             self.tracker.torrent_piece_length, self.tracker.torrent_pieces_hash,
-                                            self.tracker.torrent_num_pieces)
-        self.num_requests = 0
+                                            self.tracker.torrent_num_pieces, preallocate, sync, sendfile,
+                                            read_cache, self.tracker.torrent_files, hashers, buffers, cache,
+                                            writer, open_files)
+        if len(self.tracker.torrent_files) > 1:
+            for i, (path, length) in enumerate(self.tracker.torrent_files):
+                print(f'file {i}: {os.fsdecode(path)} ({length} bytes)')
+        # only download some of the files
+        if files is not None:
+            try:
+                self.pieces.select_files(files)
+            except ValueError as e:
+                print(f'--files: {e}')
+                exit()
         self.port = port
         self.seed = seeder
+        self.engine = engine
+        self.recheck = recheck
+        self.pieces.streaming = stream
+        self.pieces.on_verified = self.piece_verified
+        self.endgame = False
+        self.deadlines = [] # heap of (deadline, seq, peer, (index, begin), time sent) for outstanding requests
+        self.deadline_seq = itertools.count() # tie breaker so the heap never compares peers
+        self.selector = None # selectors.DefaultSelector for the select loop
+        self.dirty = set() # peers with messages queued since the last flush
+        self.haves = [] # pieces verified since the last send_haves
+        self.choker = peer.Choker(unchoke_slots)
+        self.throttled = {} # peer -> when its rate limits let it go on (select loop only)
+        self.wakeup = None # socketpair the worker threads use to wake up select
+        self.connector = peer.Connector(self.tracker.torrent_num_pieces, self.tracker.peer_id, self.tracker.info_hash,
+                                        max_half_open, connect_timeout, handshake_timeout)
 
         if seeder == 1:
             print("client running as seeder")
-            if not os.path.isfile(self.pieces.filename):
+            if self.pieces.storage.files_on_disk() < len(self.pieces.storage.selected):
                 print("file to seed not found")
                 exit()
 
     def run(self):
-        # If we are seeding the file, set bitfield to all 1
-        if self.seed == 1:
-            self.pieces.bitfield.setall(1)
-                    
-        # Init the peers list then connect to each peer
-        self.peers_manager.connect_to_peers(self.tracker.peer_list, self.tracker.peer_id, self.tracker.info_hash, self.pieces.bitfield)
+        try:
+            if self.engine == 'asyncio':
+                # imported here so the select loop doesn't pull in asyncio
+                import engine
+                engine.AsyncEngine(self).run()
+            else:
+                self.run_select()
+        except KeyboardInterrupt:
+            # keep what we've got for next time
+            print("stopping, saving resume file")
+            self.pieces.save_resume(self.tracker.info_hash, wait=True)
+            self.pieces.close()
+
+    def start(self):
+        existed = self.pieces.storage.files_on_disk() > 0
+        # open the file and give it its full size
+        self.pieces.storage.open()
+
+        # Carry on from the last run if the resume file matches the file on disk
+        if self.pieces.load_resume(self.tracker.info_hash):
+            print(f'resuming with {self.pieces.bitfield[:self.pieces.num_pieces].count()}/{self.pieces.num_pieces} pieces')
+
+        # Otherwise find out what's in the file by hashing it
+        elif self.recheck and existed:
+            start = time.time()
+            passed = self.pieces.recheck(progress=self.recheck_progress)
+            print(f'recheck: {passed}/{self.pieces.num_pieces} pieces ok in {time.time() - start:.1f}s')
+
+        # If we are seeding the file, we have every piece of the files we want
+        elif self.seed == 1:
+            # not the spare bits at the end, peers drop bitfields with those set. Nor pieces only
+            # in files left out with --files, those were never created
+            self.pieces.bitfield[:self.pieces.num_pieces] = self.pieces.picker.wanted[:self.pieces.num_pieces]
+            self.pieces.picker.set_wanted(self.pieces.bitfield)
+
+        # the streaming window starts at the first piece we don't have yet
+        self.pieces.update_window()
+
+    # File-like reader of the torrent's data from offset on that blocks until the bytes it reads
+    # are downloaded, see FileDownloader.open_stream. Call it from another thread than run()
+    def open_stream(self, offset = 0, timeout = None):
+        return self.pieces.open_stream(offset, timeout)
+
+    # print how far the recheck is every 10%
+    def recheck_progress(self, checked, total):
+        if checked == total or checked * 10 // total != (checked - 1) * 10 // total:
+            print(f'recheck: {checked}/{total} pieces')
+
+    # Change the rate limits in bytes/s while running, see peer.RateLimits.set. Safe to call
+    # from another thread, the loop picks the new limits up the next time it looks at them
+    def set_rate_limits(self, upload = None, download = None, peer_upload = None, peer_download = None):
+        self.peers_manager.limits.set(upload, download, peer_upload, peer_download)
+
+    # Hand out the unchoke slots again, by how fast peers upload to us or, once we have
+    # everything, how fast they download from us
+    def rechoke(self, now):
+        self.choker.rechoke(self.peers_manager, self.pieces.is_completed(), now)
+
+    # save the resume file if anything changed since the last time, on the storage writer thread
+    def save_resume(self):
+        if self.pieces.changed:
+            self.pieces.save_resume(self.tracker.info_hash)
+
+    def is_done(self):
+        return self.pieces.is_completed() and self.seed != 1
+
+    # Fill every unchoked peer's request pipeline with blocks it has that nobody else was asked for,
+    # in the order the piece picker hands out pieces. Shared by both engines
+    def request_blocks(self):
+        if not self.peers_manager.unchoked_peers_exist() or self.pieces.is_completed():
+            return
+
+        now = time.time()
+        self.expire_requests(now)
+
+        blocks = self.pieces.blocks
+        for peer_ in self.peers_manager.unchoked:
+            room = peer_.request_room()
+            while room > 0:
+                # new pieces only get started while there's a buffer for them
+                piece = self.pieces.picker.pick(peer_.bitfield, self.pieces.can_start_piece())
+                if piece is None:
+                    # nothing left that this peer has
+                    break
+
+                self.pieces.start_piece(piece.index)
+                self.pieces.picker.started(piece.index)
+                before = room
+                for begin in blocks.free_blocks(piece.index):
+                    # Send request for blocks we still need
+                    if (piece.index, begin) not in peer_.requests:
+                        self.send_request(peer_, piece.index, begin, now)
+                        print(f'Sent {peer_} a request for piece {piece.index} offset {begin}')
+                        room -= 1
+                        if room == 0:
+                            break
+                if room == before:
+                    # its free blocks are all out to this peer already, picking again gets the same piece
+                    break
+            # everything picked for this peer goes out as one buffer
+            peer_.send_requests()
+
+        # END GAME: once every block we need has been requested, the last few shouldn't crawl along
+        # at the speed of whoever has them. Ask every peer that has them, and cancel the rest when one arrives
+        endgame = not self.pieces.picker.fresh.any() and not any(
+            self.pieces.blocks.has_free_block(index) for index in self.pieces.picker.partial)
+        if endgame and not self.endgame:
+            print('entering endgame')
+        self.endgame = endgame
+        if endgame:
+            self.request_duplicates(now)
+
+    def request_duplicates(self, now):
+        for peer_ in self.peers_manager.unchoked:
+            room = peer_.request_room()
+            if room <= 0:
+                continue
+
+            for index in self.pieces.picker.partial:
+                if not peer_.has_piece(index):
+                    continue
+
+                for begin in self.pieces.blocks.missing_blocks(index):
+                    key = (index, begin)
+                    if key in peer_.requests:
+                        continue
+                    if sum(key in other.requests for other in self.peers_manager.unchoked) > ENDGAME_DUPLICATES:
+                        # enough peers were asked already
+                        continue
+
+                    self.send_request(peer_, index, begin, now)
+                    print(f'Sent {peer_} an endgame request for piece {index} offset {begin}')
+                    room -= 1
+                    if room == 0:
+                        break
+                if room == 0:
+                    break
+            peer_.send_requests()
+
+    # Request a block and remember when to give up on it. In endgame the same block goes to
+    # several peers, only the first one it was sent to owns it
+    def send_request(self, peer_, index, begin, now):
+        blocks = self.pieces.blocks
+        if blocks.owner_of(index, begin) is None:
+            blocks.request(index, begin, peer_)
+        peer_.add_request(index, begin, blocks.block_length(index, begin), now)
+        heapq.heappush(self.deadlines, (now + peer_.request_timeout(), next(self.deadline_seq), peer_,
+                                        (index, begin), now))
+
+    # Forget a request so the block can go to someone else
+    def release_request(self, peer_, index, begin):
+        request = peer_.release_request(index, begin)
+        self.release_block(peer_, index, begin)
+        return request
+
+    def release_all_requests(self, peer_):
+        for index, begin in peer_.release_all_requests():
+            self.release_block(peer_, index, begin)
+
+    # The peer won't be sending the block. If it owned it and another peer was asked for it too
+    # (endgame), that one owns it now. Otherwise it's free to be requested from someone else
+    def release_block(self, peer_, index, begin):
+        blocks = self.pieces.blocks
+        if blocks.owner_of(index, begin) is not peer_:
+            return
+        blocks.release(index, begin, peer_)
+        for other in self.peers_manager.unchoked:
+            if other is not peer_ and (index, begin) in other.requests:
+                blocks.request(index, begin, other)
+                return
+
+    # Resend requests that weren't answered in time. Only the requests that are due get looked at.
+    # Entries for requests that were answered, released or sent again since are just skipped
+    def expire_requests(self, now):
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, _, peer_, key, sent = heapq.heappop(self.deadlines)
+            request = peer_.requests.get(key)
+            if request is not None and request[1] == sent:
+                print(f'request timed out: piece {key[0]} offset {key[1]}')
+                self.release_request(peer_, *key)
+
+    # seconds until the next request times out, None if nothing is outstanding
+    def next_request_timeout(self):
+        if not self.deadlines:
+            return None
+        return max(0, self.deadlines[0][0] - time.time())
+
+    # A block came in. Let the peer update its pipeline, and cancel it at anybody else who was
+    # asked for it (the request timed out and went elsewhere, or endgame)
+    def block_arrived(self, peer_, index, begin, length):
+        peer_.block_received(index, begin, length, time.time())
+        if self.pieces.blocks.block(index, begin) is None:
+            return
+
+        others = self.peers_manager.unchoked if self.endgame else [self.pieces.blocks.owner_of(index, begin)]
+        for other in list(others):
+            if other is not None and other is not peer_ and self.release_request(other, index, begin) is not None:
+                other.send_cancel(index, begin, length)
+
+    # A finished piece's hash check came back from the worker threads. Good pieces get written
+    # and announced, bad ones start over
+    def piece_verified(self, index, passed):
+        if not passed:
+            print(f'hash check failed for piece {index}')
+            self.pieces.reset_piece(index)
+            return
+
+        self.pieces.write_piece_to_file(index)
+        self.pieces.update_bitfield(index)
+
+        # update interesteds, the haves go out together in send_haves
+        self.haves.append(index)
+        for peer_ in self.peers_manager:
+            peer_.piece_done(index)
+
+    # Tell every peer about the pieces we got since the last call, all in one message buffer.
+    # Called once per loop iteration after the completions
+    def send_haves(self):
+        if not self.haves:
+            return
+        print(f'send {len(self.haves)} have {len(self.peers_manager)}x')
+        data = message.pack_haves(self.haves)
+        self.haves = []
+        for peer_ in self.peers_manager:
+            peer_.send_haves(data)
+
+    # called from a worker thread, gets select to return so the loop picks up the result
+    def wake_select(self):
+        try:
+            self.wakeup[1].send(b'\0')
+        except OSError:
+            # full means it's already awake, closed means the loop is gone
+            pass
+
+    # Handle the handshake of a peer that connected to us. Returns False if it should be dropped
+    def handle_handshake(self, peer_, data):
+        handshake = message.Handshake.read_handshake(data) if len(data) == 68 else None
+        if handshake is None or handshake.info_hash != self.tracker.info_hash:
+            # something wrong with handshake
+            print("wrong handshake recvd. terminating connection")
+            return False
+
+        print(f"handshake from {peer_.addr}:{peer_.port}!")
+        peer_.peer_id = handshake.peer_id
+        peer_.connected = True
+        # reply to the handshake
+        reply = message.Handshake(self.tracker.peer_id, self.tracker.info_hash).pack()
+        peer_.send_msg(reply)
+
+        peer_.send_bitfield(self.pieces.bitfield)
+        return True
+
+    # Handle one length-prefixed message from a peer. Returns False if the peer should be dropped
+    def handle_data(self, peer_, data):
+        # update the time last seen
+        peer_.last_seen = time.time()
+
+        msg_len = message.LENGTH.unpack_from(data)[0]
+
+        if msg_len == 0:
+            print("keep alive")
+            return True
+
+        id = message.HEADER.unpack_from(data)[1]
+        if id == 7:
+            index, begin = message.INDEX_BEGIN.unpack_from(data, 5)
+            self.block_arrived(peer_, index, begin, msg_len - 9)
+
+        if not peer_.handle_message(data, id, self.pieces, self.peers_manager):
+            return False
+        self.peers_manager.update(peer_)
+        if id == 0:
+            # a choking peer won't answer our requests
+            self.release_all_requests(peer_)
+        elif id == 2:
+            self.choker.peer_interested(peer_, self.peers_manager, peer_.last_seen)
+        return True
+
+    # Pull whatever the socket has into the peer's buffer and handle every complete message.
+    # Returns False if the peer closed the connection or should be dropped
+    def receive_messages(self, peer_):
+        try:
+            n = peer_.inbox.recv_into(peer_.sock)
+        except BlockingIOError:
+            return True
+        except OSError as e:
+            print(f'{e}. closing {peer_.addr}:{peer_.port}')
+            return False
+
+        if n == 0:
+            # peer closing connection
+            return False
+
+        peer_.received(n, time.time())
+        print(f"recv'd data of len:{n}")
+        return self.handle_messages(peer_)
+
+    # Handle the complete messages sitting in the peer's buffer
+    def handle_messages(self, peer_):
+        inbox = peer_.inbox
+        if inbox.target is not None:
+            if not inbox.target_done():
+                return True
+            self.target_received(peer_)
+
+        try:
+            for data in inbox.messages():
+                if not self.handle_data(peer_, data):
+                    return False
+        except peer.MessageError as e:
+            print(f'{e}. closing {peer_.addr}:{peer_.port}')
+            return False
+
+        # A piece message that's only partly here. The rest of its block is received straight
+        # into the piece buffer, so it's only copied once, out of the kernel
+        header = inbox.piece_header()
+        if header is not None:
+            target = self.pieces.receive_block(*header)
+            if target is not None:
+                inbox.start_target(target, header)
+                if inbox.target_done():
+                    self.target_received(peer_)
+        return True
+
+    # A block received straight into its piece is all there
+    def target_received(self, peer_):
+        index, begin, length = peer_.inbox.drop_target()
+        print("piece")
+        peer_.last_seen = time.time()
+        self.block_arrived(peer_, index, begin, length)
+        self.pieces.finish_receive(index, begin)
+
+    # Remove a peer and free up the block requests that were sent to it
+    def drop_peer(self, peer_):
+        if peer_ not in self.peers_manager:
+            return
+
+        self.peers_manager.remove(peer_)
+        self.choker.remove(peer_)
+        self.throttled.pop(peer_, None)
+        self.release_all_requests(peer_)
+        if peer_.inbox.target is not None:
+            # it went away halfway through a block
+            self.pieces.abort_receive(*peer_.inbox.drop_target()[:2])
+        self.pieces.picker.peer_lost(peer_.bitfield)
+
+    # Re-announce to the tracker. Returns the (addr, port) of peers we are not connected to yet
+    def reannounce(self):
+        self.tracker.get_peer_list()
+        new_peers = []
+        for p in self.tracker.peer_list:
+            print(f'peer from tracker: {p[0]}:{p[1]}')
+
+            if not self.peers_manager.does_peer_exist(p[0], p[1]):
+                new_peers.append((p[0], p[1]))
+        return new_peers
+
+    # Peers we haven't heard from in >2min
+    def stale_peers(self):
+        now = time.time()
+        return [p for p in self.peers_manager if now - p.last_seen > 120]
+
+    # A session sends the completed announce itself, on one of its announce threads
+    def finish(self, announce = True):
+        # the file has been completely obtained from peers
+        self.pieces.save_resume(self.tracker.info_hash, wait=True)
+        self.pieces.close()
+        print("file all downloaded!")
+        print(self.pieces.cache)
+        print(self.peers_manager.limits)
+        if announce:
+            self.tracker.get_peer_list(3)
+
+    # Drop a peer and close its connection (select loop only)
+    def close_peer(self, peer_):
+        self.drop_peer(peer_)
+        if peer_.sock in self.selector.get_map():
+            self.selector.unregister(peer_.sock)
+        peer_.sock.close()
+
+    # flush this peer before the next select
+    def mark_dirty(self, peer_):
+        self.dirty.add(peer_)
+
+    # Register a connected peer's socket with the selector, the peer is the key's data
+    def register_peer(self, peer_):
+        peer_.on_queued = self.mark_dirty
+        peer_.owner = self
+        self.selector.register(peer_.sock, selectors.EVENT_READ, peer_)
+        if peer_.outbox:
+            self.dirty.add(peer_)
+
+    # Only wait for writability while a peer has queued messages. Peers with too much queued
+    # aren't read from until they catch up so they can't pile up more uploads, and neither are
+    # peers over the download limit. A peer waiting on a rate limit goes in self.throttled to be
+    # looked at again when it has tokens, and is unregistered if there is nothing to wait for
+    def update_events(self, peer_):
+        now = time.time()
+        read_delay = peer_.download_delay(now)
+        upload_delay = peer_.upload_delay(now) if peer_.upload_queue else 0
+        delays = [d for d in (read_delay, upload_delay) if d]
+        if delays:
+            self.throttled[peer_] = now + min(delays)
+        else:
+            self.throttled.pop(peer_, None)
+
+        events = 0
+        if not peer_.is_backed_up() and not read_delay:
+            events |= selectors.EVENT_READ
+        if peer_.outbox:
+            events |= selectors.EVENT_WRITE
+
+        key = self.selector.get_map().get(peer_.sock)
+        if not events:
+            if key is not None:
+                self.selector.unregister(peer_.sock)
+        elif key is None:
+            self.selector.register(peer_.sock, events, peer_)
+        elif key.events != events:
+            self.selector.modify(peer_.sock, events, peer_)
+
+    # Go on with the peers whose rate limits have tokens again
+    def unthrottle(self, now):
+        for peer_ in [p for p, until in self.throttled.items() if until <= now]:
+            del self.throttled[peer_]
+            if peer_ in self.peers_manager:
+                peer_.serve_uploads(self.pieces)
+                self.update_events(peer_)
+
+    # Put the client on a select loop. wake is what the worker threads call to wake the loop up
+    def attach(self, selector, wake):
+        self.selector = selector
+        self.connector.selector = selector
+        self.connector.owner = self
+        self.pieces.completions.wakeup = wake
+
+        # Connect to each peer from the tracker. They get registered as their handshakes finish
+        for p in self.tracker.peer_list:
+            self.connector.add(p[0], p[1])
+
+        # initialize the timers
+        print(f"tracker_timeout: {self.tracker.interval}")
+        self.next_announce = time.time() + self.tracker.interval
+        self.next_keep_alive = time.time() + 60 # in seconds
+        self.next_resume = time.time() + pieces.RESUME_INTERVAL
+
+    # Everything before a select: send requests, flush what got queued, and work out how long
+    # select can wait before one of our timers is due
+    def prepare(self):
+        # Requests are sent here
+        self.request_blocks()
+
+        # Try to send everything that got queued this pass right away, and only wait
+        # for writability on the peers whose socket didn't take all of it
+        dirty, self.dirty = self.dirty, set()
+        for peer_ in dirty:
+            if peer_ not in self.peers_manager:
+                continue
+            if peer_.flush():
+                peer_.serve_uploads(self.pieces)
+                self.update_events(peer_)
+            else:
+                self.close_peer(peer_)
+
+        now = time.time()
+        timeout = max(0, min(self.next_announce, self.next_keep_alive, self.next_resume) - now)
+        timeout = min(timeout, self.choker.timeout(now))
+        if self.connector.timeout() is not None:
+            timeout = min(timeout, self.connector.timeout())
+        if self.next_request_timeout() is not None:
+            timeout = min(timeout, self.next_request_timeout())
+        if self.pieces.storage.timeout() is not None:
+            timeout = min(timeout, self.pieces.storage.timeout())
+        if self.throttled:
+            timeout = min(timeout, max(0, min(self.throttled.values()) - now))
+        if self.dirty:
+            # uploads read in after the flush above still need to go out
+            timeout = 0
+        return timeout
+
+    # A peer that connected to us, its handshake comes in as its first message
+    def accept(self, new_sock, addr):
+        print(f"got new peer: {addr}")
+        new_sock.setblocking(0)
+
+        new_peer = peer.Peer(self.peers_manager.num_pieces, addr[0], addr[1])
+        new_peer.sock = new_sock
+        self.peers_manager.add(new_peer)
+        self.register_peer(new_peer)
+
+    # A peer that connected to us and whose handshake was already read (by a Session, which
+    # needs it to know which torrent the peer is for). inbox has whatever came after it
+    def adopt(self, new_sock, addr, inbox, handshake):
+        new_peer = peer.Peer(self.peers_manager.num_pieces, addr[0], addr[1])
+        new_peer.sock = new_sock
+        new_peer.inbox = inbox
+        self.peers_manager.add(new_peer)
+        self.register_peer(new_peer)
+        # the peer may have sent its bitfield right behind the handshake
+        if not self.handle_handshake(new_peer, handshake) or not self.handle_messages(new_peer):
+            self.close_peer(new_peer)
+
+    # Handle one selector event for one of our sockets: a half-open connection or a peer
+    def handle_event(self, key, mask):
+        sock = key.fileobj
+        peer_ = key.data #peer_ instead of peer to differentiate between module
+        if peer_ is self.connector:
+            if mask & selectors.EVENT_WRITE:
+                self.connector.on_writable(sock)
+                return
+
+            # handshake reply to one of our outbound connections
+            new_peer = self.connector.on_readable(sock)
+            if new_peer is None:
+                return
+
+            self.peers_manager.add(new_peer)
+            self.register_peer(new_peer)
+
+            # Send the new peer our bitfield
+            new_peer.send_bitfield(self.pieces.bitfield)
+
+            # the peer may have sent its bitfield right behind the handshake
+            if not self.handle_messages(new_peer):
+                self.close_peer(new_peer)
+
+        elif peer_ not in self.peers_manager:
+            # dropped earlier in this pass
+            return
+
+        elif mask & selectors.EVENT_WRITE and not peer_.flush():
+            self.close_peer(peer_)
+
+        elif not mask & selectors.EVENT_READ:
+            # flushed some of the outbox, make room for queued uploads
+            peer_.serve_uploads(self.pieces)
+            self.update_events(peer_)
+
+        elif not peer_.connected:
+            # if its a new connection, this will be a handshake
+            try:
+                n = peer_.inbox.recv_into(sock)
+            except BlockingIOError:
+                return
+            except OSError:
+                n = 0
+
+            data = peer_.inbox.take(68) if n else None
+            if n and data is None:
+                # wait for the rest of the handshake
+                return
+
+            # the peer may have sent its bitfield right behind the handshake
+            if data is None or not self.handle_handshake(peer_, data) or not self.handle_messages(peer_):
+                self.close_peer(peer_)
+
+        else:
+            # Drop peer if it closed the connection or sent something bad (e.g. a bitfield of the wrong length)
+            if not self.receive_messages(peer_):
+                print(f"closing {sock}")
+                self.close_peer(peer_)
+            else:
+                if mask & selectors.EVENT_WRITE:
+                    peer_.serve_uploads(self.pieces)
+                # stops reading if that went over the download limit
+                self.update_events(peer_)
+
+    # Everything after a select: worker thread results and the timers, except the announce
+    def tick(self, now):
+        # finished hashes and writes from the worker threads
+        self.pieces.completions.run()
+        self.send_haves()
+
+        # connects and handshakes that took too long
+        self.connector.expire()
+
+        # write out pieces that have waited long enough
+        self.pieces.storage.tick(now)
+
+        # peers that were waiting for their rate limits
+        self.unthrottle(now)
+
+        if now >= self.next_keep_alive:
+            # send keep alive to peers
+            # for p in self.peers_manager:
+            #     p.send_keep_alive()
+            self.next_keep_alive = now + 5
+
+            # take out all the peers we haven't seen in >2min
+            for p in self.stale_peers():
+                self.close_peer(p)
+
+        if now >= self.choker.next_rechoke:
+            self.rechoke(now)
+
+        if now >= self.next_resume:
+            self.save_resume()
+            self.next_resume = now + pieces.RESUME_INTERVAL
+
+    # queue up the new peers from an announce and set the time for the next one
+    def announced(self, new_peers):
+        # the connector registers them
+        for p in new_peers:
+            print('peer does not exist, attempting to add to peer list')
+            self.connector.add(p[0], p[1])
+        self.next_announce = time.time() + self.tracker.interval
+
+    # Take the client off its select loop and disconnect from peers
+    def detach(self):
+        # i dont think we should stay to become a seeder, right?
+        self.connector.close()
+        for p in self.peers_manager:
+            self.close_peer(p)
+        self.pieces.completions.wakeup = None
+
+    def run_select(self):
+        self.start()
+        self.selector = selectors.DefaultSelector()
 
         # establish the port to listen for new connections
         HOST = "0.0.0.0"  # I think this works for what we want?? idk it shows up in the connection as a real ipv4 addr but a random port
@@ -94,270 +690,100 @@ class Client():
         master_sock.setblocking(0)
         master_sock.bind((HOST, PORT))
         master_sock.listen()
-        
-        # sockets for reading incoming messages
-        reads = [peer.sock for peer in self.peers_manager.peers]
-        reads.append(master_sock)
-        new_conns = []
-
-        # initialize the timeout
-        tr_timedout = False
-        ka_timedout = False
-        tracker_timeout = self.tracker.interval
-        print(f"tracker_timeout: {tracker_timeout}")
-        keep_alive_timeout = 60 # in seconds
-
-        # Unchoke
-        for peerUn in self.peers_manager.peers:
-            peerUn.unchoke_peer()
-        
-        while not self.pieces.is_completed() or self.seed == 1:
-            time0 = time.time()
-            if(tracker_timeout < keep_alive_timeout):
-                timeout = tracker_timeout
-                tr_timedout = True
-            else:
-                timeout = keep_alive_timeout
-                ka_timedout = True
-
-            # Check for broken pipes and unconnected transport endpoints
-            for socket_ in reads:
-                # skip listening socket
-                if socket_ == master_sock:
-                    continue
-
-                try:
-                    socket_.getpeername()
-                except Exception as e:
-                    peer__ = self.peers_manager.get_peer_by_sock(socket_)
-                    print(f'{e}. closing {peer__.addr}:{peer__.port}')
-                    self.peers_manager.peers.remove(peer__)
-                    reads.remove(socket_)
-                    socket_.close()
-            
-
-            print(f'num req in pipeline: {self.num_requests}')
-            # Requests are sent here
-            if self.peers_manager.unchoked_peers_exist() and not self.pieces.is_completed() and self.num_requests < 50:
-                #piece = self.pieces.get_rarest_piece(self.peers_manager) <---- END GAME IMPLEMENTATION
-                for piece in self.pieces.piece_list:
-
-                    if piece.finished:
-                        continue
-
-                    p0 = 0
-                    peer0 = self.peers_manager.get_random_peer_by_piece(piece.index) 
-                    peer1 = self.peers_manager.get_random_peer_by_piece(piece.index)                  
-
-                    for block in piece.block_list:
-                        # resend request if block hasnt been received after 10 seconds
-                        if block.gathered == False and block.sent_to != None and time0 - block.time > 10 and self.num_requests > 0:
-                            block.sent_to = None
-                            self.num_requests -= 1
-                            print(self.num_requests)
-                        # Send request for blocks we still need
-                        if block.gathered == False and self.num_requests < 50 and block.sent_to == None:
-                            if p0 < 25:
-                                peer0.send_req(block.index, block.begin, block.length)
-                                block.sent_to = peer0
-                            else:
-                                peer1.send_req(block.index, block.begin, block.length)
-                                block.sent_to = peer1
-                            
-                            block.time = time.time()
-                            print(f'Sent {peer_} a request for {block}')
-                            self.num_requests += 1
-                            print(self.num_requests)
-
-            r, w, e, = select.select(reads, [], [], timeout)
-            for sock in r:
-                if sock is master_sock:
+        self.selector.register(master_sock, selectors.EVENT_READ, None)
+
+        # hash and write results from the worker threads
+        self.wakeup = socket.socketpair()
+        for s in self.wakeup:
+            s.setblocking(0)
+        self.selector.register(self.wakeup[0], selectors.EVENT_READ, self.pieces.completions)
+        self.attach(self.selector, self.wake_select)
+
+        while not self.is_done():
+            # start as many outbound connections as the half-open limit allows
+            self.connector.start()
+            timeout = self.prepare()
+
+            for key, mask in self.selector.select(timeout):
+                sock = key.fileobj
+                if key.data is self.pieces.completions:
+                    # just a wake up, the results are picked up below
+                    try:
+                        sock.recv(4096)
+                    except BlockingIOError:
+                        pass
+
+                elif sock is master_sock:
                     # new peer connection
-                    new_sock, addr = sock.accept()
-                    print(f"got new peer: {addr}")
-                    new_sock.setblocking(0)
-                
-                    reads.append(new_sock)
-                    new_conns.append(new_sock)
-
-                    new_peer = peer.Peer(self.peers_manager.num_pieces, addr[0], addr[1])
-                    new_peer.sock = new_sock
-                    self.peers_manager.peers.append(new_peer)
-
-                elif sock in new_conns:
-                    # if its a new connection, this will be a handshake
-                    data = receive(sock) # NOT receive_msg
-                    peer_ = self.peers_manager.get_peer_by_sock(sock)
-
-                    handshake = message.Handshake.read_handshake(data)
-                    if (handshake != None):
-                        print(f"handshake from {peer_.addr}:{peer_.port}!")
-                        peer_.peer_id = handshake.peer_id
-                        # reply to the handshake
-                        reply = message.Handshake(self.tracker.peer_id, self.tracker.info_hash).pack()
-                        peer_.send_msg(reply)
-
-                        peer_.send_bitfield(self.pieces.bitfield)
-                    else:
-                        # something wrong with handshake
-                        print("wrong handshake recvd. terminating connection")
-                        self.peers_manager.peers.remove(peer_)
-                        reads.remove(sock)
-                        sock.close()
-                    
-                    new_conns.remove(sock)
-                   
+                    self.accept(*sock.accept())
+
                 else:
-                    before_time = time.time()
-                    data = receive_msg(sock)
-                    after_time = time.time()
-
-                    data_len = len(data)
-                    print(f"recv'd data of len:{data_len}")
-                    if data:
-                        # peer with data
-                        peer_ = self.peers_manager.get_peer_by_sock(sock) #peer_ instead of peer to differentiate between module
-
-                        # update the time last seen
-                        peer_.last_seen = time.time()
-                        
-                        msg_len = struct.unpack('!L', data[:4])[0]
-                        
-                        if msg_len == 0:
-                            print("keep alive")
-                        else:                  
-                            id = struct.unpack('!b', data[4:5])[0]
-                            id = int(id)
-                            peer_.handle_message(data, id, self.pieces, reads, self.peers_manager.peers)
-                            # Validate bitfield length. Drop peer if lengths unequal
-                            if id == 5 and len(peer_.bitfield) != len(self.pieces.bitfield):
-                                break
-                            if id == 7:
-                                self.num_requests -= 1
-                            
-                        # Remove slow connections
-                        if after_time - before_time >= 1.0:
-                            print(f'SLOW CONNECTION CLOSING: {sock}')
-                            peer_ = self.peers_manager.get_peer_by_sock(sock)
-                            self.peers_manager.peers.remove(peer_)
-                            reads.remove(sock)
-                            for piece in self.pieces.piece_list:
-                                if piece.finished:
-                                    continue
-                                
-                                for block in piece.block_list:
-                                    if block.gathered == False and block.sent_to != None and block.sent_to.peer_id == peer_.peer_id:
-                                        block.sent_to = None
-                                        self.num_requests -= 1
-                            sock.close()
-
-                    else:
-                        # peer closing connection
-                        print(f"closing {sock}")
-                        peer_ = self.peers_manager.get_peer_by_sock(sock)
-                        self.peers_manager.peers.remove(peer_)
-                        reads.remove(sock)
-
-                        # Remove block requests sent to closed peer
-                        for piece in self.pieces.piece_list:
-                            if piece.finished:
-                                continue
-                            
-                            for block in piece.block_list:
-                                if block.gathered == False and block.sent_to != None and block.sent_to.peer_id == peer_.peer_id:
-                                    block.sent_to = None
-                                    self.num_requests -= 1
-
-                        sock.close()
+                    self.handle_event(key, mask)
 
             time1 = time.time()
-            keep_alive_timeout -= time1 - time0
-            tracker_timeout -= time1 - time0
-            if keep_alive_timeout < 0:
-                keep_alive_timeout = 0
-            if tracker_timeout < 0:
-                tracker_timeout = 0
-            
-
-            for sock in e:
-                print(f"if you're seeing this, idk man the socket machine broke on {sock.getpeername()}")
-                reads.remove(sock)
-                sock.close()
-            
-            if not (r or w or e):
-                print("timeout")
-                time1 = time.time()
-                if ka_timedout:
-                    # print("ka")
-                    # send keep alive to peers
-                    # for p in self.peers_manager.peers:
-                    #     p.send_keep_alive()
-                    ka_timedout = False
-                    keep_alive_timeout = 5
-                    tracker_timeout -= time1 - time0
-                    if tracker_timeout < 0:
-                        tracker_timeout = 0
-                    # print(f'new tr time: {tracker_timeout}')
-
-                elif tr_timedout:
-                    # print("tr")
-                    # connect to any new peers from tracker and add to reads
-                    self.tracker.get_peer_list()
-                    for p in self.tracker.peer_list:
-                        print(f'peer from tracker: {p[0]}:{p[1]}')
-
-                        if not self.peers_manager.does_peer_exist(p[0], p[1]):
-                            print('peer does not exist, attempting to add to peer list')
-                            p_ = self.peers_manager.connect_to_peer((p[0], p[1]), self.tracker.peer_id, self.tracker.info_hash, self.pieces.bitfield)
-                            if p_ != -1:
-                                reads.append(p_)
-
-                    tr_timedout = False
-                    tracker_timeout = self.tracker.interval
-                    keep_alive_timeout -= time1 - time0
-                    if keep_alive_timeout < 0:
-                        keep_alive_timeout = 0
-                    # print(f'new ka time: {keep_alive_timeout}')
-                
-                # take out all the peers we haven't seen in >2min
-                for p in self.peers_manager.peers:
-                    if time1 - p.last_seen > 120:
-                        self.peers_manager.peers.remove(p)
-                        reads.remove(p.sock)
-                        p.sock.close()
+            self.tick(time1)
 
-        # the file has been completely obtained from peers
-        print("file all downloaded!")
-        self.tracker.get_peer_list(3)
+            if time1 >= self.next_announce:
+                # queue up any new peers from the tracker
+                self.announced(self.reannounce())
 
-        # disconnect from peers - i dont think we should stay to become a seeder, right?
-        for s in reads:
+        self.finish()
+
+        # disconnect from peers
+        self.detach()
+        self.selector.unregister(master_sock)
+        master_sock.close()
+        self.selector.unregister(self.wakeup[0])
+        for s in self.wakeup:
             s.close()
+        self.selector.close()
         
         print("done.")
         
 
 if __name__ == '__main__':
-    # Check correct number of args
-    if len(sys.argv) < 2 or len(sys.argv) > 5:
-        print(f'Wrong number of args: {len(sys.argv)}')
-        print('To run: client.py <path to torrent> <compact format (0 or 1)> <port (optional)> <file to seed (optional)>')
-        exit()
-
-    # Check compact is safe
-    if (not sys.argv[2].isdigit()) or (int(sys.argv[2]) not in [0, 1]):
-        print('compact must be 0 (off) or 1 (on)')
-        print('To run: client.py <path to torrent> <compact format (0 or 1)> <port (optional)> <seed (0 or 1)(default 0)>')
-        exit()
-
-    if len(sys.argv) == 3:
-        # running client normally
-        client = Client(sys.argv[1], sys.argv[2])
-    elif len(sys.argv) == 4:
-        # run client on specific port
-        client = Client(sys.argv[1], sys.argv[2], int(sys.argv[3]))
-    else:
-        # run client as seeder (port must be specified)
-        client = Client(sys.argv[1], sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
-
+    parser = argparse.ArgumentParser(description='BitTorrent client')
+    parser.add_argument('torrent', help='path to torrent')
+    parser.add_argument('compact', type=int, choices=[0, 1], help='compact format (0 or 1)')
+    parser.add_argument('port', type=int, nargs='?', default=6881, help='port to listen on (default 6881)')
+    parser.add_argument('seed', type=int, nargs='?', default=0, choices=[0, 1], help='seed (0 or 1)(default 0)')
+    parser.add_argument('--engine', choices=['select', 'asyncio'], default='select',
+                        help='event loop to run peers on (default select)')
+    parser.add_argument('--half-open', type=int, default=peer.MAX_HALF_OPEN,
+                        help=f'outbound connections in flight at once (default {peer.MAX_HALF_OPEN})')
+    parser.add_argument('--connect-timeout', type=float, default=peer.CONNECT_TIMEOUT,
+                        help=f'seconds to wait for a TCP connect (default {peer.CONNECT_TIMEOUT})')
+    parser.add_argument('--handshake-timeout', type=float, default=peer.HANDSHAKE_TIMEOUT,
+                        help=f'seconds to wait for a handshake once connected (default {peer.HANDSHAKE_TIMEOUT})')
+    parser.add_argument('--preallocate', action='store_true',
+                        help='allocate the whole file on disk up front instead of making a sparse file')
+    parser.add_argument('--fsync', choices=storage.SYNC_POLICIES, default=storage.SYNC_CLOSE,
+                        help=f'when to fsync the file (default {storage.SYNC_CLOSE})')
+    parser.add_argument('--sendfile', action='store_true',
+                        help='upload blocks with os.sendfile straight from the file (select engine only)')
+    parser.add_argument('--read-cache', type=int, default=pieces.READ_CACHE_BUDGET // 2**20,
+                        help=f'MB of pieces to cache for uploading, 0 to turn it off (default {pieces.READ_CACHE_BUDGET // 2**20})')
+    parser.add_argument('--recheck', action='store_true',
+                        help='hash the pieces already in the file when there is no resume file')
+    parser.add_argument('--files', type=lambda s: [int(i) for i in s.split(',')],
+                        help='comma separated indices of the files of a multi-file torrent to download (default all)')
+    parser.add_argument('--stream', action='store_true',
+                        help=f'download in order, {pieces.STREAM_READAHEAD // 2**20} MB ahead of the first missing piece first')
+    parser.add_argument('--unchoke-slots', type=int, default=peer.UNCHOKE_SLOTS,
+                        help=f'peers to upload to at once, plus one optimistic unchoke (default {peer.UNCHOKE_SLOTS})')
+    parser.add_argument('--upload-limit', type=int, default=0,
+                        help='KB/s to upload at most, 0 for no limit (default 0)')
+    parser.add_argument('--download-limit', type=int, default=0,
+                        help='KB/s to download at most, 0 for no limit (default 0)')
+    parser.add_argument('--peer-upload-limit', type=int, default=0,
+                        help='KB/s to upload to each peer at most, 0 for no limit (default 0)')
+    parser.add_argument('--peer-download-limit', type=int, default=0,
+                        help='KB/s to download from each peer at most, 0 for no limit (default 0)')
+    args = parser.parse_args()
+
+    client = Client(args.torrent, args.compact, args.port, args.seed, args.engine, args.half_open,
+                    args.connect_timeout, args.handshake_timeout, args.preallocate, args.fsync, args.sendfile,
+                    args.read_cache * 2**20, args.recheck, args.files, args.stream,
+                    args.unchoke_slots, peer.RateLimits(args.upload_limit * 2**10, args.download_limit * 2**10,
+                                                        args.peer_upload_limit * 2**10, args.peer_download_limit * 2**10))
     client.run()
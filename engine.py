@@ -0,0 +1,275 @@
+import asyncio
+import time
+import message
+import peer
+import pieces
+
+KEEP_ALIVE_INTERVAL = 60 # in seconds
+REQUEST_INTERVAL = 1 # how often to resend timed out requests when no messages come in
+
+# Pause writing at the same high-water mark the select loop uses. One byte under it, so once
+# is_backed_up() is true drain() always has something to wait for
+def set_write_limits(writer):
+    writer.transport.set_write_buffer_limits(high=peer.SEND_HIGH_WATER - 1)
+
+# asyncio version of Client.run_select. One coroutine per peer reading with a StreamReader,
+# an asyncio server instead of master_sock, and the tracker/keep-alive timers as tasks.
+# All of the protocol logic is shared with the select loop through the Client.
+class AsyncEngine():
+    def __init__(self, client):
+        self.client = client
+        self.tasks = set()
+        self.connecting = set() # (addr, port) of outbound connections in flight
+        self.half_open = None
+        self.done = None
+        self.requests_scheduled = False
+
+    def run(self):
+        asyncio.run(self.main())
+
+    def spawn(self, coro):
+        return self.track(asyncio.ensure_future(coro))
+
+    # keep a reference so the task doesn't get garbage collected, and so main() cancels it
+    def track(self, task):
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    # Request blocks once the reads that are ready this time around the loop have all been
+    # handled, instead of after each of them. request_blocks looks at every unchoked peer
+    def schedule_requests(self):
+        if not self.requests_scheduled:
+            self.requests_scheduled = True
+            asyncio.get_running_loop().call_soon(self.send_requests)
+
+    def send_requests(self):
+        self.requests_scheduled = False
+        self.client.request_blocks()
+
+    async def main(self):
+        client = self.client
+        client.start()
+        self.done = asyncio.Event()
+        self.half_open = asyncio.Semaphore(client.connector.max_half_open)
+        # hash and write results from the worker threads come back as callbacks on the loop
+        loop = asyncio.get_running_loop()
+        client.pieces.completions.wakeup = lambda: loop.call_soon_threadsafe(self.run_completions)
+
+        server = await asyncio.start_server(self.accept_peer, "0.0.0.0", client.port)
+
+        # Connect to each peer from the tracker
+        for p in client.tracker.peer_list:
+            self.spawn(self.connect_peer(p[0], p[1]))
+
+        self.spawn(self.tracker_timer())
+        self.spawn(self.keep_alive_timer())
+        self.spawn(self.request_timer())
+        self.spawn(self.resume_timer())
+        self.spawn(self.choke_timer())
+
+        if not client.is_done():
+            await self.done.wait()
+
+        server.close()
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await server.wait_closed()
+        client.pieces.completions.wakeup = None
+
+        await asyncio.get_running_loop().run_in_executor(None, client.finish)
+        print("done.")
+
+    # Outbound connection to a peer from the tracker. At most max_half_open of these are
+    # connecting or handshaking at once, the rest wait on the semaphore
+    async def connect_peer(self, addr, port):
+        client = self.client
+        if (addr, port) in self.connecting:
+            return
+
+        self.connecting.add((addr, port))
+        try:
+            async with self.half_open:
+                streams = await self.open_peer(addr, port)
+        finally:
+            self.connecting.discard((addr, port))
+
+        if streams is None:
+            return
+        reader, writer = streams
+
+        # somebody may have connected while we were handshaking
+        if client.peers_manager.does_peer_exist(addr, port):
+            writer.close()
+            return
+
+        new_peer = peer.Peer(client.peers_manager.num_pieces, addr, port)
+        new_peer.connected = True
+        new_peer.peer_id = f'{addr}:{port}'
+        new_peer.writer = writer
+        set_write_limits(writer)
+        client.peers_manager.add(new_peer)
+        print(f'Connected to {addr}:{port}!')
+
+        # Send the new peer our bitfield
+        new_peer.send_bitfield(client.pieces.bitfield)
+
+        await self.peer_loop(new_peer, reader)
+
+    # Connect and handshake, each stage with its own timeout. Returns (reader, writer) or None
+    async def open_peer(self, addr, port):
+        connector = self.client.connector
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(addr, port), connector.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            print(f'{e}. Could not connect to {addr}:{port}')
+            return None
+
+        try:
+            writer.write(connector.handshake)
+            data = await asyncio.wait_for(reader.readexactly(68), connector.handshake_timeout)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            print(f'handshake failed with {addr}:{port}. {e}.')
+            writer.close()
+            return None
+
+        # could also check against peerid recvd from tracker but compact wont have it
+        peer_shake = message.Handshake.read_handshake(data)
+        if peer_shake is None or peer_shake.info_hash != connector.info_hash:
+            print(f'handshake failed with {addr}:{port}. Infohashes do not match')
+            writer.close()
+            return None
+
+        return reader, writer
+
+    # Callback for the asyncio server. It runs in a task of its own, tracked like ours so
+    # main() cancels it too. The server logs a handler that ends cancelled as an error, so
+    # being cancelled ends it normally
+    async def accept_peer(self, reader, writer):
+        self.track(asyncio.current_task())
+        try:
+            await self.incoming_peer(reader, writer)
+        except asyncio.CancelledError:
+            writer.close()
+
+    # The first thing a new connection sends is a handshake
+    async def incoming_peer(self, reader, writer):
+        client = self.client
+        addr = writer.get_extra_info('peername')
+        print(f"got new peer: {addr}")
+
+        new_peer = peer.Peer(client.peers_manager.num_pieces, addr[0], addr[1])
+        new_peer.writer = writer
+        set_write_limits(writer)
+        try:
+            data = await asyncio.wait_for(reader.readexactly(68), client.connector.handshake_timeout)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            print(f'{e}. No handshake from {addr}')
+            writer.close()
+            return
+
+        if not client.handle_handshake(new_peer, data):
+            writer.close()
+            return
+
+        client.peers_manager.add(new_peer)
+        await self.peer_loop(new_peer, reader)
+
+    # Read whatever the peer sends into its buffer and handle the complete messages until it goes away
+    async def peer_loop(self, peer_, reader):
+        client = self.client
+        try:
+            while True:
+                data = await reader.read(peer.MIN_RECV + peer_.inbox.missing())
+                if not data:
+                    print(f'closing {peer_.addr}:{peer_.port}')
+                    break
+
+                peer_.received(len(data), time.time())
+                peer_.inbox.feed(data)
+                if not client.handle_messages(peer_):
+                    break
+
+                self.schedule_requests()
+                if client.is_done():
+                    self.done.set()
+
+                # Serve queued uploads. only this peer waits if too much is queued for it,
+                # or if the upload limit is used up
+                while True:
+                    peer_.flush_writer()
+                    if peer_.is_backed_up():
+                        await peer_.writer.drain()
+                    if not peer_.upload_queue:
+                        break
+                    delay = peer_.upload_delay(time.time())
+                    if delay:
+                        await asyncio.sleep(delay)
+                    peer_.serve_uploads(client.pieces)
+
+                # don't read more until the download limit allows it
+                delay = peer_.download_delay(time.time())
+                if delay:
+                    await asyncio.sleep(delay)
+        except OSError as e:
+            print(f'{e}. closing {peer_.addr}:{peer_.port}')
+        finally:
+            client.drop_peer(peer_)
+            peer_.writer.close()
+
+    # Pick up finished hashes and writes. A piece passing can finish the download, and one
+    # failing frees up blocks to request
+    def run_completions(self):
+        client = self.client
+        client.pieces.completions.run()
+        client.send_haves()
+        client.request_blocks()
+        if client.is_done():
+            self.done.set()
+
+    # Re-announce every interval and connect to any new peers
+    async def tracker_timer(self):
+        client = self.client
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(client.tracker.interval)
+            # the tracker uses a blocking socket, keep it off the loop
+            new_peers = await loop.run_in_executor(None, client.reannounce)
+            for p in new_peers:
+                print('peer does not exist, attempting to add to peer list')
+                self.spawn(self.connect_peer(p[0], p[1]))
+
+    # Send keep alives and take out all the peers we haven't seen in >2min
+    async def keep_alive_timer(self):
+        client = self.client
+        while True:
+            await asyncio.sleep(KEEP_ALIVE_INTERVAL)
+            for p in client.stale_peers():
+                client.drop_peer(p)
+                p.writer.close()
+
+            for p in client.peers_manager:
+                p.send_keep_alive()
+
+    # Rechoke every RECHOKE_INTERVAL
+    async def choke_timer(self):
+        while True:
+            self.client.rechoke(time.time())
+            await asyncio.sleep(peer.RECHOKE_INTERVAL)
+
+    # Save the resume file every so often
+    async def resume_timer(self):
+        while True:
+            await asyncio.sleep(pieces.RESUME_INTERVAL)
+            self.client.save_resume()
+
+    # Requests are normally sent after each message. This catches timed out requests when the swarm goes quiet,
+    # waking up for the next request deadline if that comes first. Also flushes the storage write-back queue
+    async def request_timer(self):
+        client = self.client
+        while True:
+            timeout = client.next_request_timeout()
+            await asyncio.sleep(REQUEST_INTERVAL if timeout is None else min(REQUEST_INTERVAL, timeout))
+            client.request_blocks()
+            client.pieces.storage.tick(time.time())
@@ -1,6 +1,67 @@
 import struct
 from bitarray import bitarray
 
+# The message formats, compiled once. All of them are big-endian
+LENGTH = struct.Struct('!L') # length prefix
+HEADER = struct.Struct('!Lb') # length prefix and message id, the whole of choke..not interested
+HAVE = struct.Struct('!LbL')
+REQUEST = struct.Struct('!LbLLL') # also cancel
+PIECE_HEADER = struct.Struct('!LbLL') # piece up to the block
+INDEX_BEGIN = struct.Struct('!LL') # piece index and begin after the message id
+BLOCK_SPEC = struct.Struct('!LLL') # index, begin, length of a request or cancel
+HANDSHAKE = struct.Struct('!B19s8s20s20s')
+HANDSHAKE_PSTR = struct.Struct('!B19s')
+
+# (shortest, longest) length prefix of each message id, longest None for no fixed limit
+MSG_LENGTHS = {
+    0: (1, 1), # choke
+    1: (1, 1), # unchoke
+    2: (1, 1), # interested
+    3: (1, 1), # not interested
+    4: (5, 5), # have
+    5: (1, None), # bitfield
+    6: (13, 13), # request
+    7: (9, None), # piece
+    8: (13, 13), # cancel
+}
+
+# Encode into a preallocated buffer at offset, returns the offset after the message
+def pack_request_into(buf, offset, index, begin, length, id = 6):
+    REQUEST.pack_into(buf, offset, 13, id, index, begin, length)
+    return offset + REQUEST.size
+
+# N requests as one buffer, one sendmsg buffer instead of N little ones.
+# requests is a list of (index, begin, length)
+def pack_requests(requests):
+    buf = bytearray(REQUEST.size * len(requests))
+    offset = 0
+    for index, begin, length in requests:
+        offset = pack_request_into(buf, offset, index, begin, length)
+    return buf
+
+# Have messages for all of the indices as one buffer, encoded once and sent to every peer
+def pack_haves(indices):
+    buf = bytearray(HAVE.size * len(indices))
+    for i, index in enumerate(indices):
+        HAVE.pack_into(buf, i * HAVE.size, 5, 4, index)
+    return buf
+
+# (index, begin, block) of a piece message. The block is a memoryview of the message, not a copy
+def read_piece(bytestream):
+    index, begin = INDEX_BEGIN.unpack_from(bytestream, 5)
+    return index, begin, memoryview(bytestream)[13:]
+
+# (index, begin, length) of a request or cancel message
+def read_block_spec(bytestream):
+    return BLOCK_SPEC.unpack_from(bytestream, 5)
+
+# bitarray of a bitfield message's payload, straight from the bytes
+def read_bitfield(bytestream):
+    length = LENGTH.unpack_from(bytestream)[0]
+    bitfield = bitarray(endian='big')
+    bitfield.frombytes(bytes(memoryview(bytestream)[5:length + 4]))
+    return bitfield
+
 class Handshake():
     def __init__(self, peer_id, info_hash):
         # BitTorrent Protocol v1.0
@@ -22,18 +83,18 @@ class Handshake():
         if not isinstance(temp_peer_id, (bytes, bytearray)):
             temp_peer_id = str.encode(temp_peer_id)
             
-        buf = struct.pack('!B19s8s20s20s', self.pstrlen, self.pstr, self.reserved, self.info_hash, temp_peer_id)
+        buf = HANDSHAKE.pack(self.pstrlen, self.pstr, self.reserved, self.info_hash, temp_peer_id)
         
         return buf
 
     # Read a handshake from a peer. Change to class method?
     def read_handshake(bytestream):
-        pstrlen, pstr = struct.unpack('!B19s', bytestream[:20])
+        pstrlen, pstr = HANDSHAKE_PSTR.unpack_from(bytestream)
         if pstr != b"BitTorrent protocol":
             print('Not a BitTorrent handshake message')
             return None
 
-        packet = struct.unpack('!B19s8s20s20s', bytestream)
+        packet = HANDSHAKE.unpack(bytestream)
         try:
             peer_id = packet[4].decode('utf8')
         except Exception as e:
@@ -50,11 +111,11 @@ class KeepAlive():
         self.payload = None
     
     def pack(self):
-        return struct.pack('!L', self.len) # No msgID or payload
+        return LENGTH.pack(self.len) # No msgID or payload
 
     @classmethod
     def read(cls, bytestream):
-        len = struct.unpack('!L', bytestream[:4])[0]
+        len = LENGTH.unpack_from(bytestream)[0]
         if len != 0:
             print('Not a KeepAlive msg')
             return None
@@ -69,16 +130,16 @@ class Choke():
         self.payload = None
     
     def pack(self):
-        return struct.pack('!Lb', self.len, self.ID)
+        return HEADER.pack(self.len, self.ID)
 
     @classmethod
     def read(cls, bytestream):
-        len = struct.unpack('!L', bytestream[:4])[0]
+        len = LENGTH.unpack_from(bytestream)[0]
         if len != 1:
             print('Wrong msg len (in Choke)')
             return None
 
-        id = struct.unpack('!b', bytestream[4:5])[0]
+        id = HEADER.unpack_from(bytestream)[1]
         if id != 0:
             print('Not a Choke msg')
             return None
@@ -93,16 +154,16 @@ class UnChoke():
         self.payload = None
 
     def pack(self):
-        return struct.pack('!Lb', self.len, self.ID)
+        return HEADER.pack(self.len, self.ID)
     
     @classmethod
     def read(cls, bytestream):
-        len = struct.unpack('!L', bytestream[:4])[0]
+        len = LENGTH.unpack_from(bytestream)[0]
         if len != 1:
             print('Wrong msg len (in UnChoke)')
             return None
         
-        id = struct.unpack('!b', bytestream[4:5])[0]
+        id = HEADER.unpack_from(bytestream)[1]
         if id != 1:
             print('Not an Unchoke msg')
             return None
@@ -117,16 +178,16 @@ class Interested():
         self.payload = None
 
     def pack(self):
-        return struct.pack('!Lb', self.len, self.ID)
+        return HEADER.pack(self.len, self.ID)
     
     @classmethod
     def read(cls, bytestream):
-        len = struct.unpack('!L', bytestream[:4])[0]
+        len = LENGTH.unpack_from(bytestream)[0]
         if len != 1:
             print('Wrong msg len (in Interested)')
             return None
         
-        id = struct.unpack('!b', bytestream[4:5])[0]
+        id = HEADER.unpack_from(bytestream)[1]
         if id != 2:
             print('Not an Interested msg')
             return None
@@ -141,16 +202,16 @@ class NotInterested():
         self.payload = None
 
     def pack(self):
-        return struct.pack('!Lb', self.len, self.ID)
+        return HEADER.pack(self.len, self.ID)
 
     @classmethod
     def read(cls, bytestream):
-        len = struct.unpack('!L', bytestream[:4])[0]
+        len = LENGTH.unpack_from(bytestream)[0]
         if len != 1:
             print('Wrong msg len (in NotInterested)')
             return None
 
-        id = struct.unpack('!b', bytestream[4:5])[0]
+        id = HEADER.unpack_from(bytestream)[1]
         if id != 3:
             print('Not an NotInterested msg')
             return None
@@ -165,21 +226,21 @@ class Have():
         self.payload = piece_index
 
     def pack(self):
-        return struct.pack('!LbL', self.len, self.ID, self.payload)
+        return HAVE.pack(self.len, self.ID, self.payload)
     
     @classmethod
     def read(cls, bytestream):
-        len = struct.unpack('!L', bytestream[:4])[0]
+        len = LENGTH.unpack_from(bytestream)[0]
         if len != 5:
             print('Wrong msg len (in Have)')
             return None
 
-        id = struct.unpack('!b', bytestream[4:5])[0]
+        id = HEADER.unpack_from(bytestream)[1]
         if id != 4:
             print('Not a Have msg')
             return None
 
-        payload = struct.unpack('!L', bytestream[5:9])[0]
+        payload = LENGTH.unpack_from(bytestream, 5)[0]
 
         return Have(payload)
 
@@ -196,23 +257,18 @@ class BitField():
 
     # Bitfield should be an int
     def pack(self):
-        pack_format = '!Lb{}s'.format(self.len - 1)
-        return struct.pack(pack_format, self.len, self.ID, self.bitfield_bytes)
+        return HEADER.pack(self.len, self.ID) + self.bitfield_bytes
 
     @classmethod
     def read(cls, bytestream):
-        len = struct.unpack('!L', bytestream[:4])[0]
+        len = LENGTH.unpack_from(bytestream)[0]
 
-        id = struct.unpack('!b', bytestream[4:5])[0]
+        id = HEADER.unpack_from(bytestream)[1]
         if id != 5:
             print('Not a BitField msg')
             return None
 
-        payload_format = '!{}s'.format(len - 1)
-        payload = struct.unpack(payload_format, bytestream[5:len+4])[0]
-        bitfield = bitarray(''.join(format(byte, '08b') for byte in payload))
-
-        return BitField(bitfield)
+        return BitField(read_bitfield(bytestream))
 
 
 class Request():
@@ -222,21 +278,21 @@ class Request():
         self.payload = (index, begin, length)
 
     def pack(self):
-        return struct.pack('!LbLLL', self.len, self.ID, self.payload[0], self.payload[1], self.payload[2])
+        return REQUEST.pack(self.len, self.ID, *self.payload)
 
     @classmethod
     def read(cls, bytestream):
-        len = struct.unpack('!L', bytestream[:4])[0]
+        len = LENGTH.unpack_from(bytestream)[0]
         if len != 13:
             print('Wrong msg len (in Request)')
             return None
         
-        id = struct.unpack('!b', bytestream[4:5])[0]
+        id = HEADER.unpack_from(bytestream)[1]
         if id != 6:
             print('Not an Request msg')
             return None
 
-        payload = struct.unpack('!LLL', bytestream[5:17])
+        payload = read_block_spec(bytestream)
         
         return Request(payload[0], payload[1], payload[2])
 
@@ -250,27 +306,32 @@ class Piece():
         self.len = 9 + len(block)
 
     def pack(self):
-        pack_format = '!LbLL{}s'.format(self.len - 9)
-
         block = self.block
-        if not isinstance(block, (bytes, bytearray)):
+        if isinstance(block, str):
             block = str.encode(block)
 
-        return struct.pack(pack_format, self.len, self.ID, self.index, self.begin, block)
+        buf = bytearray(self.len + 4)
+        PIECE_HEADER.pack_into(buf, 0, self.len, self.ID, self.index, self.begin)
+        buf[PIECE_HEADER.size:] = block
+        return buf
+
+    # just the 13 byte length/id/index/begin header, so the block can be sent after it as is
+    # instead of being copied into one message
+    def pack_header(self):
+        return PIECE_HEADER.pack(self.len, self.ID, self.index, self.begin)
 
     @classmethod
     def read(cls, bytestream):
-        length = struct.unpack('!L', bytestream[:4])[0]
+        length = LENGTH.unpack_from(bytestream)[0]
 
-        id = struct.unpack('!b', bytestream[4:5])[0]
+        id = HEADER.unpack_from(bytestream)[1]
         if id != 7:
             print('Not a Piece msg')
             return None
 
-        payload_format = '!bLL{}s'.format(length - 9)
-        payload = struct.unpack(payload_format, bytestream[4:length + 4])
-        
-        return Piece(payload[1], payload[2], payload[3])
+        # the block stays a view of the message, copy it if it has to outlive the buffer
+        index, begin, block = read_piece(memoryview(bytestream)[:length + 4])
+        return Piece(index, begin, block)
 
     #new constructor for Piece using incoming Piece message
     @classmethod
@@ -287,23 +348,23 @@ class Cancel():
         self.payload = (index, begin, length)
 
     def pack(self):
-        return struct.pack('!LbLLL', self.len, self.ID, self.payload[0], self.payload[1], self.payload[2])
+        return REQUEST.pack(self.len, self.ID, *self.payload)
 
     @classmethod
     def read(cls, bytestream):
-        len = struct.unpack('!L', bytestream[:4])[0]
+        len = LENGTH.unpack_from(bytestream)[0]
         if len != 13:
             print('Wrong msg len (in Cancel)')
             return None
         
-        id = struct.unpack('!b', bytestream[4:5])[0]
+        id = HEADER.unpack_from(bytestream)[1]
         if id != 8:
             print('Not a Cancel msg')
             return None
 
-        payload = struct.unpack('!LLL', bytestream[5:18])
+        payload = read_block_spec(bytestream)
         
-        return Request(payload[0], payload[1], payload[2])
+        return Cancel(payload[0], payload[1], payload[2])
 
 # For testing
 
@@ -1,80 +1,542 @@
 import socket
+import selectors
+import asyncio
+import errno
+import math
+import os
 import random
-import struct
 import message
 import pieces
-import client
+import storage
 import time
-from typing import List
+from collections import deque
 from bitarray import bitarray
 
 BLOCK_LEN = 2**14
+RECV_BUF_LEN = 2**16 # starting size of each peer's receive buffer
+MIN_RECV = 2**14 # always leave room to recv at least this much at once
+MAX_MSG_LEN = 2**20 + 13 # anything bigger than this isn't a real message
+SEND_HIGH_WATER = 2**18 # stop reading from a peer while this much is queued for it
+MAX_IOV = 512 # most messages handed to one sendmsg call
+CONNECT_TIMEOUT = 3 # seconds for the TCP connect to a peer
+HANDSHAKE_TIMEOUT = 5 # seconds for its handshake once connected
+MAX_HALF_OPEN = 50 # outbound connections in flight at once
+REQUEST_TIMEOUT = 10 # seconds before a request is sent to someone else, until we know the peer's latency
+MIN_REQUEST_TIMEOUT = 2
+MAX_REQUEST_TIMEOUT = 30
+MIN_REQUESTS = 4 # smallest request pipeline for a peer
+MAX_REQUESTS = 1024 # biggest request pipeline for a peer (16MiB in flight)
+MAX_UPLOAD_QUEUE = 500 # requests from a peer we'll hold on to before ignoring more
+REQUEST_QUEUE_TIME = 1 # seconds of blocks to keep queued at a peer on top of its RTT
+RATE_WINDOW = 2 # seconds the transfer rates are averaged over
+UNCHOKE_SLOTS = 4 # peers we upload to at once, not counting the optimistic unchoke
+RECHOKE_INTERVAL = 10 # seconds between choker runs
+OPTIMISTIC_INTERVAL = 30 # seconds before the optimistic unchoke moves on to another peer
+SNUB_TIME = 60 # seconds we've been waiting on a peer without a block before it's snubbing us
+LIMIT_BURST = 1 # seconds worth of a rate limit that can go out at once after being idle
+
+# Transfer rate in bytes/s, exponentially averaged over about the last `window` seconds
+class RateMeter():
+    def __init__(self, window = RATE_WINDOW):
+        self.window = window
+        self.rate = 0.0
+        self.total = 0
+        self.last = time.time()
+
+    def decay(self, now):
+        if now > self.last:
+            self.rate *= math.exp((self.last - now) / self.window)
+            self.last = now
+
+    def add(self, n, now = None):
+        self.decay(now or time.time())
+        self.rate += n / self.window
+        self.total += n
+
+    def get(self, now = None):
+        self.decay(now or time.time())
+        return self.rate
+
+# Token bucket for a rate limit in bytes/s, 0 for no limit. Transfers take their bytes when they
+# happen and can run the bucket into debt, the next one waits until it's paid back. That way
+# nothing has to be split up to fit the tokens, and the average still comes out at the rate
+class TokenBucket():
+    def __init__(self, rate = 0):
+        self.rate = rate
+        self.tokens = rate * LIMIT_BURST
+        self.last = time.time()
+        self.throttled = 0.0 # seconds spent waiting for tokens
+        self.throttled_since = None
+
+    def set_rate(self, rate, now = None):
+        self.refill(now or time.time())
+        self.rate = rate
+        self.tokens = min(self.tokens, rate * LIMIT_BURST)
+
+    def refill(self, now):
+        if now > self.last:
+            self.tokens = min(self.rate * LIMIT_BURST, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+    def take(self, n, now):
+        if self.rate:
+            self.refill(now)
+            self.tokens -= n
+
+    # Seconds until there are tokens again, 0 if there are some now
+    def delay(self, now):
+        if self.rate:
+            self.refill(now)
+            if self.tokens < 0:
+                if self.throttled_since is None:
+                    self.throttled_since = now
+                return -self.tokens / self.rate
+
+        if self.throttled_since is not None:
+            self.throttled += now - self.throttled_since
+            self.throttled_since = None
+        return 0
+
+    # seconds throttled so far, the current wait included
+    def throttled_time(self, now = None):
+        if self.throttled_since is None:
+            return self.throttled
+        return self.throttled + (now or time.time()) - self.throttled_since
+
+# The global upload/download limits shared by all the peers (of every torrent in a session), and
+# the limits each peer gets on top of them. Any of them can be changed while running with set()
+class RateLimits():
+    def __init__(self, upload = 0, download = 0, peer_upload = 0, peer_download = 0):
+        self.upload = TokenBucket(upload)
+        self.download = TokenBucket(download)
+        self.peer_upload = peer_upload
+        self.peer_download = peer_download
+        self.peers = set() # every peer the per-peer limits apply to
+
+    # Change the limits in bytes/s, 0 turns a limit off and None leaves it as it is
+    def set(self, upload = None, download = None, peer_upload = None, peer_download = None):
+        now = time.time()
+        if upload is not None:
+            self.upload.set_rate(upload, now)
+        if download is not None:
+            self.download.set_rate(download, now)
+        if peer_upload is not None:
+            self.peer_upload = peer_upload
+        if peer_download is not None:
+            self.peer_download = peer_download
+        for peer_ in list(self.peers):
+            peer_.upload_limit.set_rate(self.peer_upload, now)
+            peer_.download_limit.set_rate(self.peer_download, now)
+
+    def add(self, peer_):
+        peer_.limits = self
+        peer_.upload_limit.set_rate(self.peer_upload)
+        peer_.download_limit.set_rate(self.peer_download)
+        self.peers.add(peer_)
+
+    def remove(self, peer_):
+        self.peers.discard(peer_)
 
+    def __str__(self):
+        return (f'throttled: upload {self.upload.throttled_time():.1f}s, '
+                f'download {self.download.throttled_time():.1f}s')
+
+# Tit-for-tat choker. Every RECHOKE_INTERVAL the interested peers that send to us fastest (that we
+# send to fastest once we're seeding) get the regular unchoke slots, and one more interested peer
+# is unchoked optimistically so peers we don't have a rate for get a chance. The optimistic unchoke
+# rotates every OPTIMISTIC_INTERVAL. Peers snubbing us can only get the optimistic unchoke
+class Choker():
+    def __init__(self, slots = UNCHOKE_SLOTS):
+        self.slots = slots
+        self.optimistic = None # peer unchoked optimistically
+        self.next_optimistic = 0 # when it moves on
+        self.next_rechoke = 0
+
+    # seconds until the next rechoke
+    def timeout(self, now):
+        return max(0, self.next_rechoke - now)
+
+    # peers is the PeerList. Only its interested peers are looked at, a peer that loses interest
+    # gets choked right away in Peer.handle_message
+    def rechoke(self, peers, seeding, now):
+        self.next_rechoke = now + RECHOKE_INTERVAL
+        interested = list(peers.interested)
+        if seeding:
+            rate = lambda p: p.upload.get(now)
+        else:
+            rate = lambda p: p.download.get(now)
+        regular = sorted((p for p in interested if not p.is_snubbing(now)), key=rate, reverse=True)
+        unchoke = set(regular[:self.slots])
+
+        optimistic = self.optimistic
+        if optimistic is None or optimistic not in peers.interested or now >= self.next_optimistic:
+            choked = [p for p in interested if p not in unchoke]
+            self.optimistic = random.choice(choked) if choked else None
+            self.next_optimistic = now + OPTIMISTIC_INTERVAL
+        if self.optimistic is not None:
+            unchoke.add(self.optimistic)
+
+        for p in interested:
+            if p in unchoke:
+                if p.am_choking():
+                    p.unchoke_peer()
+            elif not p.am_choking():
+                p.choke_peer()
+
+    # A peer got interested. It doesn't have to wait for the next rechoke if a slot is free
+    def peer_interested(self, peer_, peers, now):
+        if not peer_.am_choking() or peer_.is_snubbing(now):
+            return
+        if sum(not p.am_choking() for p in peers.interested) < self.slots + 1:
+            peer_.unchoke_peer()
+
+    # drop a peer that went away
+    def remove(self, peer_):
+        if self.optimistic is peer_:
+            self.optimistic = None
+
+class MessageError(Exception):
+    pass
+
+# Receive buffer for one peer connection. Sockets are read with recv_into in big chunks and
+# every complete length-prefixed message in the buffer is handed out as a memoryview slice,
+# so partial reads just wait in the buffer for the rest of the message.
+class MessageBuffer():
+    def __init__(self, size = RECV_BUF_LEN):
+        self.buf = bytearray(size)
+        self.start = 0 # first byte not handed out yet
+        self.end = 0 # end of the received data
+        # a piece message's block being received straight into its piece buffer instead
+        self.target = None # memoryview of where the block goes
+        self.target_block = None # (index, begin, length)
+        self.filled = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    # bytes still missing from the message at the front of the buffer
+    def missing(self):
+        if self.target is not None:
+            return len(self.target) - self.filled
+        pending = self.end - self.start
+        if pending < 4:
+            return 4 - pending
+        msg_len = message.LENGTH.unpack_from(self.buf, self.start)[0]
+        return max(0, 4 + msg_len - pending)
+
+    # make sure there are at least `need` free bytes after self.end
+    def reserve(self, need):
+        if self.start == self.end:
+            self.start = self.end = 0
+        if len(self.buf) - self.end >= need:
+            return
+
+        pending = self.end - self.start
+        size = len(self.buf)
+        while size - pending < need:
+            size *= 2
+
+        if size == len(self.buf):
+            # slide the pending bytes to the front. same length assignment, so old slices stay valid
+            self.buf[:pending] = self.buf[self.start:self.end]
+        else:
+            new_buf = bytearray(size)
+            new_buf[:pending] = self.buf[self.start:self.end]
+            self.buf = new_buf
+        self.start = 0
+        self.end = pending
+
+    # Returns the number of bytes received, 0 if the peer closed the connection.
+    # Raises BlockingIOError if a non-blocking socket had nothing after all
+    def recv_into(self, sock):
+        if self.target is not None:
+            # only what's left of the block, the next message goes in the buffer
+            n = sock.recv_into(self.target[self.filled:])
+            self.filled += n
+            return n
+
+        self.reserve(max(MIN_RECV, self.missing()))
+        with memoryview(self.buf) as view:
+            n = sock.recv_into(view[self.end:])
+        self.end += n
+        return n
+
+    # for data that was already read somewhere else (asyncio StreamReader)
+    def feed(self, data):
+        if self.target is not None:
+            n = min(len(data), len(self.target) - self.filled)
+            self.target[self.filled:self.filled + n] = data[:n]
+            self.filled += n
+            data = data[n:]
+
+        self.reserve(len(data))
+        self.buf[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    # Take exactly n bytes off the front (the handshake isn't length-prefixed). None if not here yet
+    def take(self, n):
+        if self.end - self.start < n:
+            return None
+        data = bytes(self.buf[self.start:self.start + n])
+        self.start += n
+        return data
+
+    # (index, begin, length) if the message at the front is a piece whose header is here but not
+    # all of its block. None otherwise
+    def piece_header(self):
+        if self.target is not None or self.end - self.start < 13:
+            return None
+        msg_len, id, index, begin = message.PIECE_HEADER.unpack_from(self.buf, self.start)
+        if id != 7 or msg_len < 9 or msg_len > MAX_MSG_LEN or self.end - self.start >= 4 + msg_len:
+            return None
+        return index, begin, msg_len - 9
+
+    # Receive the rest of the piece message at the front into target. What's already here of
+    # the block is copied over, the rest is read straight into it
+    def start_target(self, target, block):
+        have = self.end - self.start - 13
+        target[:have] = self.buf[self.start + 13:self.end]
+        self.start = self.end
+        self.target = target
+        self.target_block = block
+        self.filled = have
+
+    def target_done(self):
+        return self.target is not None and self.filled == len(self.target)
+
+    # Stop receiving into the target, returns its (index, begin, length)
+    def drop_target(self):
+        block = self.target_block
+        if self.target is not None:
+            self.target.release()
+        self.target = None
+        self.target_block = None
+        self.filled = 0
+        return block
+
+    # Yield every complete message in the buffer, length prefix included.
+    # The slices are only valid until the next recv_into/feed so don't hold onto them
+    def messages(self):
+        view = memoryview(self.buf)
+        try:
+            while self.end - self.start >= 4:
+                msg_len = message.LENGTH.unpack_from(view, self.start)[0]
+                if msg_len > MAX_MSG_LEN:
+                    raise MessageError(f'message of len {msg_len} is too big')
+                if self.end - self.start < 4 + msg_len:
+                    break
+                if msg_len:
+                    # a message of the wrong size for its id would blow up whoever decodes it
+                    lengths = message.MSG_LENGTHS.get(view[self.start + 4])
+                    if lengths is not None and (msg_len < lengths[0] or (lengths[1] is not None and msg_len > lengths[1])):
+                        raise MessageError(f'message id {view[self.start + 4]} of wrong len {msg_len}')
+
+                msg = view[self.start:self.start + 4 + msg_len]
+                self.start += 4 + msg_len
+                yield msg
+                msg.release()
+        finally:
+            view.release()
+
+# All of the connected peers. Indexed by socket fd and by (addr, port), with sets of the peers
+# that aren't choking us and the peers interested in us kept up to date by update()
 class PeerList():
-    def __init__(self, num_pieces):
-        self.peers: List[Peer] = []
+    def __init__(self, num_pieces, limits = None):
+        self.by_fd = {}
+        self.by_addr = {}
+        self.limits = limits or RateLimits()
+        self.unchoked = set() # peers not choking us
+        self.interested = set() # peers interested in us
         self.num_pieces = num_pieces
 
-    # Connect to each peer with the handshake
-    def connect_to_peers(self, peers_list, peer_id, infohash, my_bitfield):
-        for peer in peers_list:
-            self.connect_to_peer(peer, peer_id, infohash, my_bitfield)
-            
-    
-    def connect_to_peer(self, peer, peer_id, infohash, my_bitfield):
-        # Handshake
-        # peer[0]: hostname/ip, peer[1]: port, both are from tracker
-        new_peer = Peer(self.num_pieces, peer[0], peer[1])
-        retval = new_peer.handshake(peer[0], peer[1], peer_id, infohash)
-        
-        # Skip peer if handshake fails
-        if retval == -1:
-            return -1
-
-        # Add to peers list
-        #retval.setblocking(False) # Peer sockets will not block. GOOD OR NAH??
-        retval.settimeout(None)
-        new_peer.sock = retval
-        self.peers.append(new_peer)
-        
-        # Send the new peer our bitfield           
-        new_peer.send_bitfield(my_bitfield)
-
-        # only used when connecting to new peers recvd from reannouncing to tracker
-        return retval
-    
-    def get_peer_by_sock(self, sock):
-        for peer in self.peers:
-            if peer.sock == sock:
-                return peer
-    
-    # returns a random peer that has the piece specified by index, if any
-    def get_random_peer_by_piece(self, index):
-        have_piece = [peer for peer in self.peers if peer.bitfield[index] and not peer.is_choking()]
-        if len(have_piece) == 0:
-            return None
-        p = random.choice(have_piece)        
-        return p
+    def __len__(self):
+        return len(self.by_addr)
+
+    # iterate over a copy so peers can be dropped while looping
+    def __iter__(self):
+        return iter(list(self.by_addr.values()))
+
+    def __contains__(self, peer):
+        return self.by_addr.get((peer.addr, peer.port)) is peer
+
+    def add(self, peer):
+        self.by_addr[(peer.addr, peer.port)] = peer
+        if peer.sock is not None:
+            peer.fd = peer.sock.fileno()
+            self.by_fd[peer.fd] = peer
+        self.limits.add(peer)
+        self.update(peer)
+
+    def remove(self, peer):
+        if self.by_addr.get((peer.addr, peer.port)) is peer:
+            del self.by_addr[(peer.addr, peer.port)]
+        if peer.fd is not None and self.by_fd.get(peer.fd) is peer:
+            del self.by_fd[peer.fd]
+        self.unchoked.discard(peer)
+        self.interested.discard(peer)
+        self.limits.remove(peer)
+
+    # call after the peer's choke/interested state changes
+    def update(self, peer):
+        if peer.is_choking():
+            self.unchoked.discard(peer)
+        else:
+            self.unchoked.add(peer)
 
-    def get_num_peers_by_piece(self, index):
-        count = 0
-        for peer in self.peers:
-            if peer.bitfield[index] and not peer.is_choking():
-                count += 1
+        if peer.state['peer_interested']:
+            self.interested.add(peer)
+        else:
+            self.interested.discard(peer)
 
-        return count
+    def get_peer_by_sock(self, sock):
+        return self.by_fd.get(sock.fileno())
     
     def unchoked_peers_exist(self):
-        for peer in self.peers:
-            if not peer.is_choking():
-                return True
-        return False
+        return len(self.unchoked) > 0
     
     def does_peer_exist(self, addr, port):
-        for peer in self.peers:
-            if peer.addr == addr and peer.port == port:
-                return True
-        return False
+        return (addr, port) in self.by_addr
+
+
+# Opens outbound connections without blocking the loop. Up to max_half_open connects and
+# handshakes are in flight at once, and the loop picks up each peer as soon as its handshake is done.
+# Half-open sockets are registered on the loop's selector with the Connector as their data
+class Connector():
+    def __init__(self, num_pieces, peer_id, info_hash, max_half_open = MAX_HALF_OPEN,
+                 connect_timeout = CONNECT_TIMEOUT, handshake_timeout = HANDSHAKE_TIMEOUT):
+        self.num_pieces = num_pieces
+        self.handshake = message.Handshake(peer_id, info_hash).pack()
+        self.info_hash = info_hash
+        self.max_half_open = max_half_open
+        self.connect_timeout = connect_timeout
+        self.handshake_timeout = handshake_timeout
+        self.waiting = deque() # (addr, port) not started yet
+        self.half_open = {} # sock -> [peer, deadline, handshaking]
+        self.known = set() # (addr, port) waiting or half open
+        self.selector = None # set by the loop before start()
+        self.owner = None # the Client, for a Session to hand it this connector's events
+
+    def __len__(self):
+        return len(self.waiting) + len(self.half_open)
+
+    def __contains__(self, sock):
+        return sock in self.half_open
+
+    # queue up a peer from the tracker
+    def add(self, addr, port):
+        if (addr, port) in self.known:
+            return
+        self.known.add((addr, port))
+        self.waiting.append((addr, port))
+
+    # Start connecting to waiting peers until we hit the half-open limit, or have started room
+    # of them (a Session shares its limits between torrents). Returns how many were started
+    def start(self, room = None):
+        limit = self.max_half_open if room is None else min(self.max_half_open, len(self.half_open) + room)
+        started = 0
+        while self.waiting and len(self.half_open) < limit:
+            addr, port = self.waiting.popleft()
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setblocking(False)
+            err = s.connect_ex((addr, port))
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                print(f'{os.strerror(err)}. Could not connect to {addr}:{port}')
+                s.close()
+                self.known.discard((addr, port))
+                continue
+
+            new_peer = Peer(self.num_pieces, addr, port)
+            new_peer.sock = s
+            # goes out as soon as the connect finishes
+            new_peer._send(self.handshake)
+            self.half_open[s] = [new_peer, time.time() + self.connect_timeout, False]
+            # writable once the connect finishes
+            self.selector.register(s, selectors.EVENT_WRITE, self)
+            started += 1
+        return started
+
+    # seconds until the next connect or handshake times out, None if nothing is in flight
+    def timeout(self):
+        if not self.half_open:
+            return None
+        return max(0, min(entry[1] for entry in self.half_open.values()) - time.time())
+
+    def fail(self, sock, reason):
+        new_peer = self.half_open.pop(sock)[0]
+        print(f'{reason}. Could not connect to {new_peer.addr}:{new_peer.port}')
+        self.known.discard((new_peer.addr, new_peer.port))
+        self.selector.unregister(sock)
+        sock.close()
+
+    def on_writable(self, sock):
+        entry = self.half_open[sock]
+        if not entry[2]:
+            # the connect finished, one way or the other
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self.fail(sock, os.strerror(err))
+                return
+            entry[1] = time.time() + self.handshake_timeout
+            entry[2] = True
+
+        if not entry[0].flush():
+            self.fail(sock, 'handshake not sent')
+            return
+
+        # wait for the reply, and keep writing if some of our handshake is left
+        events = selectors.EVENT_READ
+        if entry[0].outbox:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(sock, events, self)
+
+    # Returns the peer once its handshake checks out, None if it isn't done yet or failed
+    def on_readable(self, sock):
+        new_peer = self.half_open[sock][0]
+        try:
+            n = new_peer.inbox.recv_into(sock)
+        except BlockingIOError:
+            return None
+        except OSError as e:
+            self.fail(sock, e)
+            return None
+
+        if n == 0:
+            self.fail(sock, 'Peer closed connection')
+            return None
+
+        data = new_peer.inbox.take(68)
+        if data is None:
+            # wait for the rest of the handshake
+            return None
+
+        # could also check against peerid recvd from tracker but compact wont have it
+        peer_shake = message.Handshake.read_handshake(data)
+        if peer_shake is None or peer_shake.info_hash != self.info_hash:
+            self.fail(sock, 'Infohashes do not match')
+            return None
+
+        # the loop registers it again with the peer as its data
+        del self.half_open[sock]
+        self.selector.unregister(sock)
+        self.known.discard((new_peer.addr, new_peer.port))
+        new_peer.connected = True
+        new_peer.peer_id = f'{new_peer.addr}:{new_peer.port}'
+        print(f'Connected to {new_peer.addr}:{new_peer.port}!')
+        return new_peer
+
+    # drop every connect or handshake that took too long
+    def expire(self):
+        now = time.time()
+        for s in [s for s, entry in self.half_open.items() if entry[1] <= now]:
+            self.fail(s, 'handshake timed out' if self.half_open[s][2] else 'connect timed out')
+
+    def close(self):
+        for s in self.half_open:
+            self.selector.unregister(s)
+            s.close()
+        self.half_open.clear()
+        self.waiting.clear()
+        self.known.clear()
 
 
 # peer class that handles the communication between peers
@@ -92,62 +554,109 @@ class Peer():
         self.bitfield = bitarray(num_pieces if num_pieces%8==0 else num_pieces+(8-(num_pieces%8))) # should be a multiple of 8
         self.bitfield[:] = 0 # set bits to 0
         self.sock = None # this might not need to be kept here
+        self.fd = None # sock's fd while it's in a PeerList
+        self.writer = None # asyncio StreamWriter when running on the asyncio engine
+        self.inbox = MessageBuffer() # bytes received but not handled yet
+        self.outbox = deque() # encoded messages waiting for the socket to be writable
+        self.outbox_len = 0 # bytes in the outbox not sent yet
+        self.out_offset = 0 # how much of outbox[0] already went out
+        self.flush_scheduled = False
+        self.on_queued = None # called with the peer when its outbox stops being empty
+        self.owner = None # the Client, for a Session to hand it this peer's events
         self.peer_id = None # For finding peer later
         self.addr = addr
         self.port = port
         self.last_seen = time.time()
+        self.requests = {} # (index, begin) -> (length, time sent) we requested from this peer and haven't got yet
+        self.unsent = [] # (index, begin, length) of requests not encoded yet, see send_requests
+        self.wanted_pieces = 0 # how many pieces the peer has that we need, see update_am_interested
+        self.upload_queue = deque() # (index, begin, length) the peer requested from us, not read from disk yet
+        self.max_requests = MIN_REQUESTS # how many requests to keep in flight, see block_received
+        self.download = RateMeter() # bytes/s of blocks from this peer
+        self.upload = RateMeter() # bytes/s of blocks to this peer
+        self.waiting_since = None # last block, or first request after it, we're still waiting on, see is_snubbing
+        self.limits = None # the PeerList's RateLimits
+        self.upload_limit = TokenBucket() # this peer's own limits, set by the RateLimits
+        self.download_limit = TokenBucket()
+        self.rtt = None # smoothed request -> block latency
+        self.rtt_var = 0 # and how much it varies
+        self.min_rtt = None
         
-    # hostname and port are of the external peer this is connecting to, peer_id is the client's id
-    def handshake(self, hostname, port, peer_id, info_hash):
-        # TCP connection
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(0.2)
-
-        try:
-            s.connect((hostname, port))
-        except Exception as e:
-            print(f'{e}. Could not connect to {hostname}:{port}')
-            s.close()
-            return -1
-
-        # Complete handshake
-        data = message.Handshake(peer_id, info_hash).pack() 
-        s.sendall(data)
-
-        # If handshake times out, discard peer connection
-        try:
-            data = s.recv(68)
-        except Exception as e:
-            print(f'handshake failed with {hostname}:{port}. {e}.')
-            s.close()
-            return -1
-
-        # If peer sends a b'' packet, they and suck and closed us
-        if data == b'':
-            print(f'handshake failed with {hostname}:{port}. Peer closed connection')
-            s.close()
-            return -1
-
-        peer_shake = message.Handshake.read_handshake(data)
-
-        # could also check against peerid recvd from tracker but compact wont have it
-        if peer_shake is None or peer_shake.info_hash != info_hash:
-            # something went wrong
-            print(f'handshake failed with {hostname}:{port}. Infohashes do not match')
-            s.close()
-            return -1
+    # Queue an encoded message. Nothing is written until the socket is writable, so a peer
+    # with a full TCP window never blocks anyone else
+    def _send(self, data):
+        self.outbox.append(data)
+        self.outbox_len += len(data)
+        if self.writer is not None:
+            if not self.flush_scheduled:
+                # everything queued during this loop iteration goes out together
+                self.flush_scheduled = True
+                asyncio.get_running_loop().call_soon(self.flush_writer)
+        elif len(self.outbox) == 1 and self.on_queued is not None:
+            self.on_queued(self)
+
+    # bytes queued for this peer that haven't made it to the kernel
+    def queued(self):
+        if self.writer is not None:
+            return self.outbox_len + self.writer.transport.get_write_buffer_size()
+        return self.outbox_len
+
+    # too much queued, stop reading from this peer until it catches up
+    def is_backed_up(self):
+        return self.queued() >= SEND_HIGH_WATER
+
+    # Write as much of the outbox as the socket takes. Small messages are handed to the
+    # kernel together in one sendmsg, file ranges go out with sendfile. Returns False if the
+    # connection is broken
+    def flush(self):
+        while self.outbox:
+            try:
+                if isinstance(self.outbox[0], storage.FileRange):
+                    attempted = len(self.outbox[0]) - self.out_offset
+                    sent = self.outbox[0].sendfile(self.sock, self.out_offset)
+                else:
+                    bufs = [memoryview(self.outbox[0])[self.out_offset:]]
+                    for i in range(1, min(len(self.outbox), MAX_IOV)):
+                        if isinstance(self.outbox[i], storage.FileRange):
+                            break
+                        bufs.append(self.outbox[i])
+                    attempted = sum(len(buf) for buf in bufs)
+
+                    if len(bufs) == 1:
+                        sent = self.sock.send(bufs[0])
+                    else:
+                        sent = self.sock.sendmsg(bufs)
+            except BlockingIOError:
+                return True
+            except OSError as e:
+                print(f'{e}. Could not send to {self.addr}:{self.port}')
+                return False
+
+            self.outbox_len -= sent
+            sent_total = sent
+            sent += self.out_offset
+            while self.outbox and sent >= len(self.outbox[0]):
+                sent -= len(self.outbox.popleft())
+            self.out_offset = sent
+
+            if sent_total < attempted:
+                # kernel buffer is full, wait until the socket is writable again
+                return True
+        return True
 
-        self.connected = True
-        self.peer_id = f'{hostname}:{port}'
-        self.sock = s
+    # asyncio version of flush. the transport buffers whatever the socket doesn't take
+    def flush_writer(self):
+        self.flush_scheduled = False
+        if self.writer is None or self.writer.is_closing():
+            return
+        self.writer.writelines(self.outbox)
+        self.outbox.clear()
+        self.outbox_len = 0
 
-        print(f'Connected to {hostname}:{port}!')
-        return s  
-    
     # sends generic msg 
     def send_msg(self, msg):
         print("send msg")
-        self.sock.sendall(msg)
+        self._send(msg)
     
     def has_piece(self, index):
         return self.bitfield[index]
@@ -155,17 +664,24 @@ class Peer():
     def am_choking(self):
         return self.state['am_choking']
     
+    # We've been waiting on it for a long time without a block. Requests that time out and get
+    # sent again (to it or anyone else) don't start the wait over, only a block or a choke does
+    def is_snubbing(self, now):
+        return self.waiting_since is not None and now - self.waiting_since > SNUB_TIME
+
     def choke_peer(self):
         self.state['am_choking'] = True
+        # a choked peer's requests are dropped
+        self.upload_queue.clear()
         data = message.Choke().pack() 
         print("send choke")
-        self.sock.sendall(data)
+        self._send(data)
     
     def unchoke_peer(self):
         self.state['am_choking'] = False
         data = message.UnChoke().pack()
         print("send unchoke")
-        self.sock.sendall(data)
+        self._send(data)
     
     def is_choking(self):
         return self.state['peer_choking']
@@ -176,25 +692,151 @@ class Peer():
     def unchoke_self(self):
         self.state['peer_choking'] = False
 
-    # update whether or not client should be interested in this peer.
-    def update_am_interested(self, my_bitfield):
-        for i, x in enumerate(my_bitfield):
-            # If peers bf is set and mine is not, we want that piece
-            if self.bitfield[i] and not x:
-                self.state['am_interested'] = True
-                return True
-        self.state['am_interested'] = False
-        return False
+    # Update whether or not client should be interested in this peer from the pieces we still
+    # need (FileDownloader.needed()). Have messages and finished pieces keep the count up to date
+    # after this, see peer_has and piece_done
+    def update_am_interested(self, needed):
+        self.wanted_pieces = (self.bitfield & needed).count()
+        return self.set_am_interested(self.wanted_pieces > 0)
+
+    # Tell the peer when we become (not) interested, nothing if that didn't change
+    def set_am_interested(self, interested):
+        if interested != self.state['am_interested']:
+            self.state['am_interested'] = interested
+            if interested:
+                self.send_am_interested()
+            else:
+                self.send_not_interested()
+        return interested
+
+    # The peer got a piece. Returns False if it already had it
+    def peer_has(self, index, downloader):
+        if self.bitfield[index]:
+            return False
+        self.bitfield[index] = 1
+        downloader.picker.peer_have(index)
+        if downloader.needs(index):
+            self.wanted_pieces += 1
+            self.set_am_interested(True)
+        return True
+
+    # We got a piece, one less for this peer to give us if it has it
+    def piece_done(self, index):
+        if self.bitfield[index] and self.wanted_pieces > 0:
+            self.wanted_pieces -= 1
+            if self.wanted_pieces == 0:
+                self.set_am_interested(False)
     
+    # how many more requests fit in this peer's pipeline
+    def request_room(self):
+        return self.max_requests - len(self.requests)
+
+    # Request a block. Who owns the block is kept in the downloader's BlockTable by the client
+    # The request is encoded with the others added before the next send_requests()
+    def add_request(self, index, begin, length, now):
+        if self.waiting_since is None:
+            # snubbing is counted from the first request it has to answer
+            self.waiting_since = now
+        self.unsent.append((index, begin, length))
+        self.requests[(index, begin)] = (length, now)
+
+    # Queue the requests added since the last call, all in one buffer
+    def send_requests(self):
+        if self.unsent:
+            self._send(message.pack_requests(self.unsent))
+            self.unsent = []
+
+    # Forget an outstanding request. Returns (length, time sent), None if it wasn't outstanding
+    def release_request(self, index, begin):
+        return self.requests.pop((index, begin), None)
+
+    # Forget all outstanding requests, returns their (index, begin). It choked us or went away,
+    # so we aren't waiting on it anymore
+    def release_all_requests(self):
+        keys = list(self.requests)
+        self.requests.clear()
+        self.waiting_since = None
+        return keys
+
+    # How long to wait for a block before asking someone else. Like TCP's retransmit timeout,
+    # the smoothed latency plus 4 times its variation
+    def request_timeout(self):
+        if self.rtt is None:
+            return REQUEST_TIMEOUT
+        return max(MIN_REQUEST_TIMEOUT, min(MAX_REQUEST_TIMEOUT, self.rtt + 4 * self.rtt_var))
+
+    # A block came in. Update the rate and latency estimates and size the pipeline to the
+    # bandwidth-delay product: enough requests to cover the RTT plus REQUEST_QUEUE_TIME at this rate
+    def block_received(self, index, begin, length, now):
+        request = self.requests.pop((index, begin), None)
+        self.download.add(length, now)
+        # waiting on it again from here, if there's anything left to wait for
+        self.waiting_since = now if self.requests else None
+        if request is not None:
+            sample = now - request[1]
+            self.min_rtt = sample if self.min_rtt is None else min(self.min_rtt, sample)
+            if self.rtt is None:
+                self.rtt = sample
+                self.rtt_var = sample / 2
+            else:
+                # same smoothing TCP uses for its retransmit timer
+                self.rtt_var += (abs(sample - self.rtt) - self.rtt_var) / 4
+                self.rtt += (sample - self.rtt) / 8
+
+        depth = math.ceil(self.download.get(now) * ((self.min_rtt or 0) + REQUEST_QUEUE_TIME) / BLOCK_LEN)
+        self.max_requests = max(MIN_REQUESTS, min(MAX_REQUESTS, depth))
+
+    # Turn queued requests into piece messages while there's room in the outbox. Blocks are
+    # only read from disk when the socket can take them, so a Cancel can still pull them
+    # They also wait in the queue while the upload limit is used up, see upload_delay
+    def serve_uploads(self, downloader):
+        now = time.time()
+        while self.upload_queue and self.queued() < SEND_HIGH_WATER and not self.upload_delay(now):
+            index, begin, length = self.upload_queue.popleft()
+            if self.limits is not None:
+                self.limits.upload.take(length, now)
+                self.upload_limit.take(length, now)
+            # with sendfile the block goes from the file to the socket inside the kernel.
+            # the asyncio transport can't do that, it gets the mapped block
+            block = downloader.block_range(index, begin, length) if self.writer is None else None
+            if block is None:
+                block = downloader.read_block(index, begin, length)
+            self.send_piece(index, begin, block)
+
+    # Seconds until the global and this peer's upload limit let another block out, 0 if they do now
+    def upload_delay(self, now):
+        if self.limits is None:
+            return 0
+        return max(self.limits.upload.delay(now), self.upload_limit.delay(now))
+
+    # Same for reading more from the peer
+    def download_delay(self, now):
+        if self.limits is None:
+            return 0
+        return max(self.limits.download.delay(now), self.download_limit.delay(now))
+
+    # n bytes were read from the peer
+    def received(self, n, now):
+        if self.limits is not None:
+            self.limits.download.take(n, now)
+            self.download_limit.take(n, now)
+
+    def cancel_upload(self, index, begin, length):
+        try:
+            self.upload_queue.remove((index, begin, length))
+        except ValueError:
+            # already sent, or never asked for
+            pass
+
     def send_am_interested(self):
         data = message.Interested().pack()
         print("send interested")
-        self.sock.sendall(data)
+        self._send(data)
     
     def send_not_interested(self):
         data = message.NotInterested().pack()
         print("send not interested")
-        self.sock.sendall(data)
+        self._send(data)
     
     def check_am_interested(self):
         return self.state['am_interested']
@@ -212,39 +854,47 @@ class Peer():
     def send_have(self, piece_index):
         data = message.Have(piece_index).pack()
         #print("send have")
-        try:
-            self.sock.sendall(data)
-        except Exception as e:
-            print(f'{e}. Could not send have to {self.sock}')
+        self._send(data)
 
     def send_bitfield(self, bitfield):
         data = message.BitField(bitfield).pack()
         print("send bitfield")
-        self.sock.sendall(data)
+        self._send(data)
     
+    # Haves from message.pack_haves, the same buffer goes to every peer
+    def send_haves(self, data):
+        self._send(data)
+
     def send_req(self, index, begin, length):
         data = message.Request(index, begin, length).pack()
         #print("send request")
-        self.sock.sendall(data)
+        self._send(data)
 
+    # The header and the block are queued as two buffers and go out in the same sendmsg,
+    # so the block (usually a view of the mapped file) is never copied. The block can also be
+    # a storage.FileRange, which flush() sends with sendfile
     def send_piece(self, index, begin, block):
-        data = message.Piece(index, begin, block).pack()
+        msg = message.Piece(index, begin, block)
         print("send piece")
-        self.sock.sendall(data)
+        self._send(msg.pack_header())
+        self._send(block)
+        self.upload.add(len(block))
     
     def send_cancel(self, index, begin, length):
         data = message.Cancel(index, begin, length).pack()
-        self.sock.sendall(data)
+        self._send(data)
 
     def send_keep_alive(self):
         data = message.KeepAlive().pack()
         print("send keep alive")
-        self.sock.sendall(data)
+        self._send(data)
 
+    # the peer_id from an inbound handshake can be raw bytes, the address is always printable
     def __str__(self):
-        return self.peer_id
+        return f'{self.addr}:{self.port}'
     
-    def handle_message(self, bytestream, id, downloader: pieces.FileDownloader, reads, peer_list):
+    # returns False if the peer sent something that should get it dropped
+    def handle_message(self, bytestream, id, downloader: pieces.FileDownloader, peer_list: PeerList):
         if id == 0:
             print("choke")
             self.choke_self()
@@ -260,76 +910,82 @@ class Peer():
 
         elif id == 2:
             print("interested")
+            # the client's choker decides whether it gets unchoked
             self.peer_is_interested()
-            # automatically send an unchoke back?? if we have the pieces ?
-            self.unchoke_peer()
 
         elif id == 3:
             print("not interested")
             self.peer_is_not_interested()
-            self.choke_peer()
+            # frees up its unchoke slot for the next rechoke
+            if not self.am_choking():
+                self.choke_peer()
 
         elif id == 4:
             print("have")
             index = message.Have.read(bytestream)
-            # Set peers bitfield
-            self.bitfield[index.payload] = 1
-            self.state['am_interested']
-            self.send_am_interested()
+            if index.payload >= downloader.num_pieces:
+                print(f"Have for a piece that doesn't exist. Closing {self.addr}:{self.port}")
+                return False
+
+            # Set peers bitfield, we get interested if it's a piece we need
+            self.peer_has(index.payload, downloader)
 
         elif id == 5:
             print("bitfield")
             # Update peer's bitfield
             bf = message.BitField.read(bytestream)
+            if len(bf.bitfield) != len(downloader.bitfield):
+                print(f"Wrong bitfield length. Closing {self.addr}:{self.port}")
+                return False
+            if bf.bitfield[downloader.num_pieces:].any():
+                print(f"Spare bits set in bitfield. Closing {self.addr}:{self.port}")
+                return False
+
+            downloader.picker.peer_bitfield(self.bitfield, bf.bitfield)
             self.bitfield = bf.bitfield
 
-            if len(self.bitfield) != len(downloader.bitfield):
-                print(f"Wrong bitfield length. Closing {self.getpeername()}")
-                reads.remove(self.sock)
-                self.sock.close()
-                return
-
             # Check if peer has a piece we are intersted in
-            if self.update_am_interested(downloader.bitfield):
-                self.send_am_interested()
+            self.update_am_interested(downloader.needed())
 
         elif id == 6:
             print("request")
-            index, begin, length = struct.unpack("!LLL", bytestream[5:17])
+            index, begin, length = message.read_block_spec(bytestream)
             
-            if not downloader.bitfield[index] or length > BLOCK_LEN:
-                # they requested something we dont have, or something bigger than 14KB; ignore
-                return
+            if (index >= downloader.num_pieces or not downloader.bitfield[index] or length > BLOCK_LEN
+                    or begin + length > downloader.blocks.piece_length(index)):
+                # they requested something we dont have, something bigger than 14KB, or something
+                # past the end of the piece; ignore
+                return True
 
-            # Send the correct block from the file
-            with open(downloader.filename, 'rb') as file:
-                file.seek((index*downloader.piece_len)+begin)
-                data = file.read(length)
-                self.send_piece(index, begin, data)
+            if self.am_choking() or len(self.upload_queue) >= MAX_UPLOAD_QUEUE:
+                return True
+
+            # The block is read from the file when it's its turn to go out
+            self.upload_queue.append((index, begin, length))
+            self.serve_uploads(downloader)
 
         elif id == 7:
             print("piece")
-            raw_block = message.Piece.read(bytestream)
-            block = pieces.Block(raw_block.index, raw_block.begin, len(raw_block.block), True, raw_block.block, self)
-            downloader.update_block(block)
-
-            piece = downloader.piece_list[block.index]
-            '''WARNING!! - if everything is recvd but the hash doesn't pass, is_complete still marks the Piece as finished.
-                as long as we check stuff with bitfield and not piece.finished this doesnt matter'''
-            if piece.is_complete() and piece.checkHash():
-                downloader.write_piece_to_file(piece.index)
-                downloader.update_bitfield(piece.index)
-                
-                # send have for all peers and update interesteds
-                print(f'send have {len(peer_list)}x')
-                for peer in peer_list:
-                    if not peer.update_am_interested(downloader.bitfield):
-                        self.send_not_interested()
-                    peer.send_have(piece.index)
+            # the block is copied from the receive buffer into its piece and nowhere else
+            index, begin, block = message.read_piece(bytestream)
+            if index >= downloader.num_pieces or downloader.bitfield[index]:
+                # we already have it (a duplicate from endgame)
+                return True
+
+            if not downloader.update_block(index, begin, block):
+                return True
+
+            if downloader.blocks.is_complete(index):
+                # hashed and written off the event loop, the client gets the result in piece_verified
+                downloader.verify_piece(index)
 
         elif id == 8:
             print("cancel")
-            index, begin, length = struct.unpack("!III", bytestream[5:17])[0]
+            index, begin, length = message.read_block_spec(bytestream)
+            # drop it from the uploads if it hasn't gone out yet
+            self.cancel_upload(index, begin, length)
 
         else:
-            print("unknown packet id")
\ No newline at end of file
+            print("unknown packet id")
+
+        return True
\ No newline at end of file
@@ -1,25 +1,256 @@
 import time
 import math
 import os
+import random
+import io
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import storage
+import bencoder
 from hashlib import sha1
 from typing import List
 from bitarray import bitarray
 
 BLOCK_LEN = 2**14
 
-class Block():
-    def __init__(self, index, begin, length, gathered = False, data = b'', send_to = None) -> None:
-        self.index = index
-        self.begin = begin
-        self.data = data
-        self.length = length
-        self.gathered = gathered
-        self.sent_to = send_to
-        self.time = 0
+# Piece buffers come out of a pool sized to this much memory, whatever the size of the torrent
+PIECE_BUFFER_BUDGET = 2**27
+MIN_PIECE_BUFFERS = 8
+READ_CACHE_BUDGET = 2**26 # memory for pieces cached to serve uploads
+RESUME_INTERVAL = 30 # seconds between saves of the resume file
+RECHECK_CHUNK = 2**20 # bytes read at a time when hashing pieces on disk
+HASH_WORKERS = min(4, os.cpu_count() or 1) # threads checking finished pieces
+STREAM_READAHEAD = 2**24 # bytes ahead of a stream's position that are downloaded first
+
+# Download state of every block in the torrent. Block i of piece p is number p*blocks_per_piece + i,
+# and its state is a bit in each bitarray instead of an object per 16KB
+class BlockTable():
+    def __init__(self, num_pieces, piece_len, final_piece_len) -> None:
+        self.num_pieces = num_pieces
+        self.piece_len = piece_len
+        self.final_piece_len = final_piece_len
+        self.blocks_per_piece = math.ceil(piece_len / BLOCK_LEN)
+        num_blocks = num_pieces * self.blocks_per_piece
+        self.gathered = bitarray(num_blocks)
+        self.gathered.setall(0)
+        self.requested = bitarray(num_blocks) # somebody has been asked for it
+        self.requested.setall(0)
+        self.owner = {} # block -> peer it was requested from, only for blocks in flight
+        self.receiving = set() # blocks being read straight off a socket into their piece
+
+    def piece_length(self, index):
+        return self.final_piece_len if index == self.num_pieces - 1 else self.piece_len
+
+    def block_length(self, index, begin):
+        return min(BLOCK_LEN, self.piece_length(index) - begin)
+
+    # first block of a piece and one past its last
+    def _range(self, index):
+        start = index * self.blocks_per_piece
+        return start, start + math.ceil(self.piece_length(index) / BLOCK_LEN)
+
+    # block number, None if (index, begin) isn't the start of a block
+    def block(self, index, begin):
+        if index >= self.num_pieces or begin % BLOCK_LEN != 0 or begin >= self.piece_length(index):
+            return None
+        return index * self.blocks_per_piece + begin // BLOCK_LEN
+
+    # offsets of the blocks of a piece nobody has been asked for yet
+    def free_blocks(self, index):
+        start, end = self._range(index)
+        taken = self.gathered[start:end] | self.requested[start:end]
+        return [i * BLOCK_LEN for i in taken.search(0)]
+
+    # offsets of the blocks of a piece we don't have, requested or not
+    def missing_blocks(self, index):
+        start, end = self._range(index)
+        return [i * BLOCK_LEN for i in self.gathered[start:end].search(0)]
+
+    def has_free_block(self, index):
+        start, end = self._range(index)
+        return not (self.gathered[start:end] | self.requested[start:end]).all()
+
+    # which blocks of a piece we have, one bit per block
+    def gathered_blocks(self, index):
+        start, end = self._range(index)
+        return self.gathered[start:end]
+
+    def is_complete(self, index):
+        start, end = self._range(index)
+        return self.gathered[start:end].all()
+
+    def owner_of(self, index, begin):
+        return self.owner.get(self.block(index, begin))
+
+    def request(self, index, begin, peer):
+        block = self.block(index, begin)
+        self.requested[block] = 1
+        self.owner[block] = peer
+
+    # the peer won't be sending it, so it can be asked from someone else
+    def release(self, index, begin, peer):
+        block = self.block(index, begin)
+        if block is not None and self.owner.get(block) is peer:
+            del self.owner[block]
+            self.requested[block] = 0
+
+    # Mark a block as received. False if we already had it, or it's on its way in from another peer
+    def gather(self, index, begin):
+        block = self.block(index, begin)
+        if self.gathered[block] or block in self.receiving:
+            return False
+        self.gathered[block] = 1
+        self.requested[block] = 0
+        self.owner.pop(block, None)
+        return True
+
+    # A block is about to be received straight into its piece. False if it's not wanted anymore
+    def start_receive(self, index, begin):
+        block = self.block(index, begin)
+        if self.gathered[block] or block in self.receiving:
+            return False
+        self.receiving.add(block)
+        return True
+
+    def finish_receive(self, index, begin):
+        self.receiving.discard(self.block(index, begin))
+        return self.gather(index, begin)
+
+    def abort_receive(self, index, begin):
+        self.receiving.discard(self.block(index, begin))
+
+    def reset(self, index):
+        start, end = self._range(index)
+        self.gathered[start:end] = 0
+        self.requested[start:end] = 0
+        for block in range(start, end):
+            self.owner.pop(block, None)
+
+# Reusable piece buffers. Buffers in use take up at most budget bytes (or min_buffers of them,
+# for torrents with huge pieces), and they go back in the pool once the piece is written out, so
+# memory depends on the pieces in flight and not the torrent size. A Session shares one between
+# its torrents, so free buffers of one piece size are dropped to make room for another. Torrents
+# starting up on another thread take buffers for their resumed pieces, hence the lock
+class BufferPool():
+    def __init__(self, budget = PIECE_BUFFER_BUDGET, min_buffers = MIN_PIECE_BUFFERS) -> None:
+        self.lock = threading.Lock()
+        self.budget = budget
+        self.min_buffers = min_buffers
+        self.allocated = 0 # bytes in all the buffers, in use or free
+        self.in_use = 0 # bytes in the buffers in use
+        self.buffers_in_use = 0
+        self.free = {} # buffer length -> free buffers
+
+    def available(self, length):
+        return self.in_use + length <= self.budget or self.buffers_in_use < self.min_buffers
+
+    # a buffer of length bytes, None if the budget is used up
+    def get(self, length):
+        with self.lock:
+            if not self.available(length):
+                return None
+            self.in_use += length
+            self.buffers_in_use += 1
+            if self.free.get(length):
+                return self.free[length].pop()
+
+            # make room out of free buffers of other sizes
+            for free in self.free.values():
+                while free and self.allocated + length > self.budget:
+                    self.allocated -= len(free.pop())
+            self.allocated += length
+        return bytearray(length)
+
+    def put(self, buffer):
+        with self.lock:
+            self.in_use -= len(buffer)
+            self.buffers_in_use -= 1
+            self.free.setdefault(len(buffer), []).append(buffer)
+
+# Whole pieces we've read to serve uploads, least recently used thrown out first once they take
+# up more than budget bytes. Peers mostly ask for the same few new pieces, so the first request
+# for a piece reads all of it and the rest of its blocks come from memory. Pieces are keyed by
+# (owner, index), so the torrents of a Session can share one
+class ReadCache():
+    def __init__(self, budget = READ_CACHE_BUDGET) -> None:
+        self.budget = budget
+        self.size = 0
+        self.pieces = OrderedDict() # (owner, piece index) -> data, most recently used last
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-    
     def __str__(self) -> str:
-        return f'Piece {self.index}: Block offset {self.begin} and Block length {self.length}'
+        return (f'read cache: {len(self.pieces)} pieces, {self.size} bytes, hits={self.hits} '
+                f'misses={self.misses} evictions={self.evictions}')
+
+    # the piece's data, None if it isn't cached
+    def get(self, key):
+        data = self.pieces.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.pieces.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.budget or key in self.pieces:
+            return
+        self.pieces[key] = data
+        self.size += len(data)
+        while self.size > self.budget:
+            _, old = self.pieces.popitem(last=False)
+            self.size -= len(old)
+            self.evictions += 1
+
+    # drop all of an owner's pieces
+    def remove(self, owner):
+        for key in [key for key in self.pieces if key[0] is owner]:
+            self.size -= len(self.pieces.pop(key))
+
+# Reads the torrent's data from a FileDownloader while it's downloading, see open_stream
+class Stream(io.RawIOBase):
+    def __init__(self, downloader, offset, timeout = None) -> None:
+        super().__init__()
+        self.downloader = downloader
+        self.pos = offset
+        self.timeout = timeout
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.downloader.storage.size
+        self.pos = max(0, offset)
+        self.downloader.update_window()
+        return self.pos
+
+    def readinto(self, b):
+        n = min(len(b), self.downloader.storage.size - self.pos)
+        if n <= 0:
+            return 0
+        self.downloader.wait_for(self.pos, n, self.timeout)
+        data = self.downloader.storage.pread(self.pos, n)
+        b[:len(data)] = data
+        self.pos += len(data)
+        self.downloader.update_window()
+        return len(data)
+
+    def close(self):
+        self.downloader.streams.discard(self)
+        self.downloader.update_window()
+        super().close()
 
 class Piece():
     def __init__(self, index, length, hash) -> None:
@@ -27,48 +258,125 @@ class Piece():
         self.length = length
         self.hash = hash
         self.num_blocks = math.ceil(length / BLOCK_LEN)
-        self.block_list = self.build_block_list()
-        self.data = bytearray(length)
+        self.data = None # buffer from the pool while the piece is being downloaded
         self.finished = False
     
     def __str__(self) -> str:
         return f'Piece {self.index}: len={self.length}, hash={self.hash}'
 
-    def build_block_list(self) -> List[Block]:
-        block_list = []
-        for i in range(self.num_blocks - 1):
-            block_list.append(Block(self.index, i*BLOCK_LEN, BLOCK_LEN))
-
-        final_block_offset = ((self.num_blocks-1)*BLOCK_LEN)
-
-        block_list.append(Block(self.index, final_block_offset, self.length - final_block_offset))
-        return block_list
-
-    def is_complete(self):
-        for block in self.block_list:
-            if not block.gathered:
-                return False
-
-        self.finished = True
-        return True
-    
     def checkHash(self):
         if not self.finished:
             print('missing data')
             return False
         
-        return self.hash == sha1(self.data).digest()
+        return self.hash == sha1(memoryview(self.data)[:self.length]).digest()
 
-    def reset(self):
-        self.block_list = self.build_block_list()
-        self.data = bytearray(self.length)
-        self.finished = False
 
-        
+# Rarest-first piece picker. Counts how many connected peers have each piece, updated as bitfields,
+# haves and disconnects come in. levels[k] has a bit set for every piece exactly k peers have,
+# so picking is a few whole-bitarray ANDs instead of asking every peer about every piece
+class PiecePicker():
+    def __init__(self, piece_list, bitfield, blocks):
+        self.piece_list = piece_list
+        self.blocks = blocks
+        self.num_pieces = len(piece_list)
+        self.availability = [0] * self.num_pieces
+        self.levels = [bitarray(len(bitfield))]
+        self.levels[0].setall(0)
+        self.levels[0][:self.num_pieces] = 1
+        self.partial = {} # pieces with blocks requested but not verified yet, oldest first
+        self.wanted = bitarray(len(bitfield)) # pieces of the files we want
+        self.wanted.setall(0)
+        self.wanted[:self.num_pieces] = 1
+        self.window = None # pieces to get first and in order (streaming), None for plain rarest first
+        self.set_wanted(bitfield)
+
+    # (re)start from the pieces we have, e.g. when seeding
+    def set_wanted(self, bitfield):
+        # pieces we need that nobody has been asked for
+        self.fresh = ~bitfield & self.wanted
+        for index in list(self.partial):
+            if bitfield[index]:
+                del self.partial[index]
+
+    def _move(self, index, delta):
+        count = self.availability[index]
+        self.levels[count][index] = 0
+        count += delta
+        if count == len(self.levels):
+            level = bitarray(len(self.fresh))
+            level.setall(0)
+            self.levels.append(level)
+        self.levels[count][index] = 1
+        self.availability[index] = count
+
+    # a peer sent its bitfield (replacing what it had told us before)
+    def peer_bitfield(self, old_bitfield, bitfield):
+        self.peer_lost(old_bitfield)
+        for index in bitfield.search(1):
+            if index < self.num_pieces:
+                self._move(index, 1)
+
+    def peer_have(self, index):
+        self._move(index, 1)
+
+    # a peer went away, its pieces are that much rarer
+    def peer_lost(self, bitfield):
+        for index in bitfield.search(1):
+            if index < self.num_pieces:
+                self._move(index, -1)
+
+    # Next piece to request from a peer with this bitfield, None if it has nothing we need.
+    # Pieces already in progress come first so they finish, then (if fresh is set) the first
+    # piece in the streaming window, then the rarest piece nobody has been asked for yet, with
+    # ties broken randomly
+    def pick(self, peer_bitfield, fresh=True):
+        for index in self.partial:
+            if peer_bitfield[index] and self.blocks.has_free_block(index):
+                return self.piece_list[index]
+
+        if not fresh:
+            return None
+        candidates = peer_bitfield & self.fresh
+        if not candidates.any():
+            return None
+
+        window = self.window
+        if window is not None:
+            index = (candidates & window).find(1)
+            if index != -1:
+                return self.piece_list[index]
+
+        for level in self.levels[1:]:
+            rarest = level & candidates
+            if rarest.any():
+                # first candidate after a random spot, wrapping around
+                index = rarest.find(1, random.randrange(self.num_pieces))
+                if index == -1:
+                    index = rarest.find(1)
+                return self.piece_list[index]
+        return None
+
+    # blocks of this piece are being requested
+    def started(self, index):
+        if self.fresh[index]:
+            self.fresh[index] = 0
+            self.partial[index] = True
+
+    def finished(self, index):
+        self.partial.pop(index, None)
+        self.fresh[index] = 0
+
+    # the piece failed its hash check and has to be downloaded again
+    def reset(self, index):
+        self.partial.pop(index, None)
+        self.fresh[index] = 1
 
 
 class FileDownloader():
-    def __init__(self, filename, file_len, piece_len, pieces, num_pieces) -> None:
+    def __init__(self, filename, file_len, piece_len, pieces, num_pieces, preallocate = False,
+                 sync = storage.SYNC_CLOSE, sendfile = False, read_cache = READ_CACHE_BUDGET, files = None,
+                 hashers = None, buffers = None, cache = None, writer = None, open_files = None) -> None:
         self.filename = filename
         self.filesize = file_len
         self.num_pieces = num_pieces
@@ -78,25 +386,129 @@ class FileDownloader():
         self.bitfield.setall(0)
         self.piecehash = self.cutPieceHash(pieces)
         self.piece_list = self.build_piece_list()
+        self.blocks = BlockTable(num_pieces, piece_len, self.final_piece_len)
+        # the buffer pool, read cache, hash and writer threads and open files can all be shared
+        # by the torrents of a Session
+        self.buffers = buffers or BufferPool()
+        self.picker = PiecePicker(self.piece_list, self.bitfield, self.blocks)
+        self.completions = storage.Completions() # results from the hash and disk threads for the event loop
+        # [(path, length)] of a multi-file torrent, a single-file one is just the one
+        self.storage = storage.Storage(files or [(filename, file_len)], preallocate, sync, sendfile, self.completions,
+                                       writer, open_files)
+        self.hashers = hashers or ThreadPoolExecutor(HASH_WORKERS)
+        self.on_verified = None # called on the event loop with (piece index, passed) after verify_piece
+        self.cache = cache or ReadCache(read_cache)
+        self.resume_file = filename + b'.resume' if isinstance(filename, bytes) else filename + '.resume'
+        self.changed = False # anything to save in the resume file
+        self.saving = False # a save of the resume file is on the writer thread
+        self.unwritten = set() # verified pieces still on their way to disk
+        self.available = threading.Condition() # notified as pieces make it to disk, for streams
+        self.streams = set() # open Streams, the picker gets the pieces ahead of them first
+        self.streaming = False # keep a window ahead of the first missing piece without a stream
+        self.readahead = STREAM_READAHEAD
     
     def __str__(self) -> str:
         return f"FileDownloader for {self.filename}:[{self.piecehash}]"
 
+    # have all the pieces of the files we want
     def is_completed(self):
-        # Use all() ?
-        for i in range(self.num_pieces):
-            if not self.bitfield[i]:
-                return False
-        return True
+        return not self.needed().any()
 
-    def update_block(self, recv_block: Block):
-        piece = self.piece_list[recv_block.index]
-        old_block = piece.block_list[int(recv_block.begin / BLOCK_LEN)]
-        if old_block.length == recv_block.length:
-            piece.data[recv_block.begin:recv_block.begin+recv_block.length] = recv_block.data
-            piece.block_list[int(recv_block.begin / BLOCK_LEN)] = recv_block
-        else:
+    # pieces of the files we want that we don't have yet
+    def needed(self):
+        return self.picker.wanted & ~self.bitfield
+
+    def needs(self, piece_index):
+        return self.picker.wanted[piece_index] and not self.bitfield[piece_index]
+
+    # Only download the files with these indices (in the order the torrent lists them). The
+    # pieces they're in are wanted, pieces that are only in other files are skipped. ValueError
+    # for an index that isn't one of the torrent's files
+    def select_files(self, indices):
+        files = self.storage.files
+        for i in indices:
+            if not 0 <= i < len(files):
+                raise ValueError(f'there is no file {i}, the torrent has files 0 to {len(files) - 1}')
+        self.storage.selected = set(indices)
+        wanted = bitarray(len(self.bitfield))
+        wanted.setall(0)
+        for i in indices:
+            if files.lengths[i] > 0:
+                wanted[files.starts[i] // self.piece_len:(files.starts[i] + files.lengths[i] - 1) // self.piece_len + 1] = 1
+        self.picker.wanted = wanted
+        self.picker.set_wanted(self.bitfield)
+
+    # a piece can only be started while there's a buffer for it
+    def can_start_piece(self):
+        return self.buffers.available(self.piece_len)
+
+    # Give a piece a buffer before its blocks are requested. False if the pool is empty
+    def start_piece(self, piece_index):
+        piece = self.piece_list[piece_index]
+        if piece.data is None:
+            piece.data = self.buffers.get(self.piece_len)
+        return piece.data is not None
+
+    def release_piece(self, piece_index):
+        piece = self.piece_list[piece_index]
+        if piece.data is not None:
+            self.buffers.put(piece.data)
+            piece.data = None
+
+    # Copy a received block into its piece. Returns False if it isn't one we're waiting for
+    def update_block(self, index, begin, data):
+        block = self.blocks.block(index, begin)
+        if block is None or self.piece_list[index].data is None:
+            # not a block, or a piece we're not downloading (e.g. a late one after a failed hash)
+            return False
+        if len(data) != self.blocks.block_length(index, begin):
             print('block lengths not equal')
+            return False
+        if not self.blocks.gather(index, begin):
+            # got it from someone else already
+            return False
+
+        self.piece_list[index].data[begin:begin+len(data)] = data
+        self.changed = True
+        return True
+
+    # Where to receive a block to straight off the socket: a view of its spot in the piece buffer.
+    # None if it isn't one we're waiting for. finish_receive or abort_receive has to follow
+    def receive_block(self, index, begin, length):
+        block = self.blocks.block(index, begin)
+        if block is None or self.bitfield[index] or self.piece_list[index].data is None:
+            return None
+        if length != self.blocks.block_length(index, begin) or not self.blocks.start_receive(index, begin):
+            return None
+        return memoryview(self.piece_list[index].data)[begin:begin+length]
+
+    # the block from receive_block is all there
+    def finish_receive(self, index, begin):
+        if not self.blocks.finish_receive(index, begin):
+            return
+        self.changed = True
+        if self.blocks.is_complete(index):
+            self.verify_piece(index)
+
+    # the peer went away halfway through the block
+    def abort_receive(self, index, begin):
+        self.blocks.abort_receive(index, begin)
+
+    # All the blocks of a piece are in. It's hashed on a worker thread, and on_verified gets the
+    # result back on the event loop. No more blocks get written to it in the meantime, they're all gathered
+    def verify_piece(self, piece_index):
+        piece = self.piece_list[piece_index]
+        piece.finished = True
+        future = self.hashers.submit(piece.checkHash)
+        future.add_done_callback(lambda future: self.completions.post(self.on_verified, piece_index, future.result()))
+
+    # the piece failed its hash check and has to be downloaded again
+    def reset_piece(self, piece_index):
+        self.release_piece(piece_index)
+        self.piece_list[piece_index].finished = False
+        self.changed = True
+        self.blocks.reset(piece_index)
+        self.picker.reset(piece_index)
             
     def cutPieceHash(self, pieces):
         hashList = []
@@ -122,43 +534,241 @@ class FileDownloader():
         piece = self.piece_list[piece_index]
         if piece.finished:
             self.bitfield[piece_index] = 1
-            print(f'Updated bitfield: {self.bitfield}')
+            self.picker.finished(piece_index)
+            self.changed = True
+            self.update_window()
+            print(f'Updated bitfield: {self.bitfield.count()}/{self.num_pieces} pieces')
             return True
         else:
             print('Piece not complete')
             return False
 
+    # A block of a piece we have, for uploading. Comes out of the read cache, reading the whole
+    # piece into it on a miss. Without a cache it's a view of the mapped file
+    def read_block(self, index, begin, length):
+        if self.cache.budget == 0:
+            return self.storage.read((index*self.piece_len)+begin, length)
+
+        data = self.cache.get((self, index))
+        if data is None:
+            data = bytes(self.storage.read(index*self.piece_len, self.piece_list[index].length))
+            self.cache.put((self, index), data)
+        return memoryview(data)[begin:begin+length]
+
+    # The same block as a range of the file to sendfile, None if sendfile can't be used for it
+    def block_range(self, index, begin, length):
+        return self.storage.file_range((index*self.piece_len)+begin, length)
+
+    # Hand a verified piece to the storage write-back queue. Its buffer goes back to the
+    # pool once it's on disk
     def write_piece_to_file(self, piece_index):
         piece = self.piece_list[piece_index]
-       
-        if not os.path.isfile(self.filename):
-            f = open(self.filename, 'wb')
+        self.unwritten.add(piece_index)
+        self.storage.write(piece_index*self.piece_len, memoryview(piece.data)[:piece.length],
+                           lambda: self.piece_written(piece_index))
 
-        else:
-            f = open(self.filename, 'r+b')
-        
-        f.seek(piece_index*self.piece_len)
-        f.write(piece.data)
-        f.close()
-
-    def get_rarest_piece(self, peers_manager):
-        least_peers = 0
-        rare_index = 0
-        for piece in self.piece_list:
-            if piece.finished:
+    # the piece is on disk, streams waiting for it can have it
+    def piece_written(self, piece_index):
+        self.release_piece(piece_index)
+        with self.available:
+            self.unwritten.discard(piece_index)
+            self.available.notify_all()
+
+    # Start downloading in order from a read position. The pieces in the readahead window past
+    # each open stream's position (and with streaming mode, past the first piece we're missing)
+    # are requested first, everything else is rarest first as usual
+    def update_window(self):
+        positions = [stream.pos // self.piece_len for stream in list(self.streams)]
+        if self.streaming:
+            missing = (self.picker.wanted & ~self.bitfield).find(1)
+            if missing != -1:
+                positions.append(missing)
+        if not positions:
+            self.picker.window = None
+            return
+
+        pieces = max(1, self.readahead // self.piece_len)
+        window = bitarray(len(self.bitfield))
+        window.setall(0)
+        for position in positions:
+            window[position:position + pieces] = 1
+        # swapped in whole, streams move it from their own threads
+        self.picker.window = window
+
+    # A file-like reader of the torrent's data from offset on, for reading while it downloads.
+    # Meant to be used from a thread other than the event loop: reads block until the pieces
+    # they cover are verified and on disk (TimeoutError after timeout seconds, if given). Bytes
+    # in pieces that aren't being downloaded, see select_files, raise OSError straight away
+    def open_stream(self, offset = 0, timeout = None):
+        stream = Stream(self, offset, timeout)
+        self.streams.add(stream)
+        self.update_window()
+        return stream
+
+    # block until the range is verified and written
+    def wait_for(self, offset, length, timeout = None):
+        first = offset // self.piece_len
+        last = (offset + length - 1) // self.piece_len
+        # wanted is only set before the download starts, so these would never come
+        if not (self.bitfield[first:last + 1] | self.picker.wanted[first:last + 1]).all():
+            raise OSError(f'bytes {offset}-{offset + length} are in files that are not being downloaded')
+        with self.available:
+            ready = self.available.wait_for(
+                lambda: self.bitfield[first:last + 1].all() and not any(i in self.unwritten for i in range(first, last + 1)),
+                timeout)
+        if not ready:
+            raise TimeoutError(f'bytes {offset}-{offset + length} not downloaded after {timeout}s')
+
+    # write out everything and close the file
+    def close(self):
+        self.storage.close()
+        self.cache.remove(self)
+
+    # SHA-1 of a piece as it is in the file, read RECHECK_CHUNK at a time
+    def hash_on_disk(self, piece_index):
+        digest = sha1()
+        offset = piece_index*self.piece_len
+        end = offset + self.piece_list[piece_index].length
+        while offset < end:
+            data = self.storage.pread(offset, min(RECHECK_CHUNK, end - offset))
+            if not data:
+                # file is short
+                break
+            digest.update(data)
+            offset += len(data)
+        return digest.digest()
+
+    # Check what's already in the file against the piece hashes and mark the pieces that pass as
+    # ones we have. Pieces are hashed on a pool of threads (hashlib lets go of the GIL on big
+    # buffers, and so does pread), so it goes as fast as the disk and not one core.
+    # progress(checked, num_pieces) is called as pieces finish. Returns how many passed
+    def recheck(self, workers = None, progress = None):
+        self.storage.open()
+        passed = 0
+        with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+            # map hands results back in order, while the threads work ahead
+            for index, digest in enumerate(pool.map(self.hash_on_disk, range(self.num_pieces))):
+                good = digest == self.piecehash[index]
+                self.bitfield[index] = good
+                passed += good
+                if progress is not None:
+                    progress(index + 1, self.num_pieces)
+
+        self.picker.set_wanted(self.bitfield)
+        self.changed = True
+        return passed
+
+    # Save what's been downloaded so a restart can carry on from here: the verified pieces, the
+    # blocks of pieces in progress, and the size and mtime of the file as of the save. Blocks of
+    # unfinished pieces only live in their buffers, so they're copied out here and written to the
+    # file first. The writes, fsyncs and the resume file all happen on the storage writer thread,
+    # after everything already queued for it, and resume_saved hears back through completions.
+    # With wait it's saved before returning
+    def save_resume(self, info_hash, wait = False):
+        if self.saving and not wait:
+            return
+        blocks = [] # (offset, data) of the blocks of unfinished pieces
+        partial = {}
+        for index in self.picker.partial:
+            piece = self.piece_list[index]
+            gathered = self.blocks.gathered_blocks(index)
+            if piece.data is None or not gathered.any():
                 continue
+            for i in gathered.search(1):
+                begin = i * BLOCK_LEN
+                length = self.blocks.block_length(index, begin)
+                blocks.append((index*self.piece_len + begin, bytes(piece.data[begin:begin+length])))
+            partial[str(index).encode()] = gathered.tobytes()
 
-            num_peers_at_i = peers_manager.get_num_peers_by_piece(piece.index)
-            # print(f"{piece.index}:{num_peers_at_i} ", end="")
-            if num_peers_at_i > 0 and (num_peers_at_i < least_peers or least_peers == 0):
-                least_peers = num_peers_at_i
-                rare_index = piece.index
-        
-        if least_peers == 0:
-            print("no peer has any piece???")
-            return None
-        return self.piece_list[rare_index]
+        resume = {
+            b'info-hash': info_hash,
+            b'pieces': self.bitfield.tobytes(),
+            b'partial': partial,
+        }
+        self.changed = False
+        self.saving = True
+        self.storage.submit(lambda: self.write_resume(resume, blocks), self.resume_saved, wait)
 
+    # Runs on the storage writer thread
+    def write_resume(self, resume, blocks):
+        for offset, data in blocks:
+            self.storage.write_now(offset, data)
+        # everything the resume file says we have has to be on disk before it does
+        self.storage.fsync()
+        resume[b'files'] = self.storage.fingerprint()
+
+        tmp = self.resume_file + (b'.tmp' if isinstance(self.resume_file, bytes) else '.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(bencoder.encode(resume))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.resume_file)
+
+    def resume_saved(self, future):
+        self.saving = False
+        try:
+            future.result()
+        except OSError as e:
+            print(f'{e}. could not save the resume file')
+            # try again next time
+            self.changed = True
+
+    # Carry on from the resume file if it's for this torrent and the file hasn't been touched
+    # since it was saved. Returns False if there's no usable resume file
+    def load_resume(self, info_hash):
+        try:
+            with open(self.resume_file, 'rb') as f:
+                resume = bencoder.decode(f.read())
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print(f'{e}. ignoring resume file')
+            return False
+
+        if (not isinstance(resume, dict) or resume.get(b'info-hash') != info_hash
+                or resume.get(b'files') != self.storage.fingerprint()):
+            print('resume file is out of date, ignoring it')
+            return False
+
+        bitfield = bitarray()
+        bitfield.frombytes(resume.get(b'pieces', b''))
+        if len(bitfield) != len(self.bitfield):
+            print('resume file is for a different number of pieces, ignoring it')
+            return False
+        self.bitfield[:] = bitfield
+        self.bitfield[self.num_pieces:] = 0
+        self.picker.set_wanted(self.bitfield)
+
+        # read the blocks of unfinished pieces back into buffers
+        for key, blocks in resume.get(b'partial', {}).items():
+            index = int(key)
+            if index >= self.num_pieces or self.bitfield[index]:
+                continue
+            if not self.start_piece(index):
+                # out of buffers, the rest start over
+                break
+
+            gathered = bitarray()
+            gathered.frombytes(blocks)
+            piece = self.piece_list[index]
+            for i in gathered[:piece.num_blocks].search(1):
+                begin = i * BLOCK_LEN
+                length = self.blocks.block_length(index, begin)
+                piece.data[begin:begin+length] = self.storage.read(index*self.piece_len + begin, length)
+                self.blocks.gather(index, begin)
+            self.picker.started(index)
+
+            if self.blocks.is_complete(index):
+                # saved between the last block and the hash check
+                piece.finished = True
+                if piece.checkHash():
+                    self.write_piece_to_file(index)
+                    self.update_bitfield(index)
+                else:
+                    self.reset_piece(index)
+
+        self.changed = False
+        return True
 
 
 
@@ -0,0 +1,320 @@
+import argparse
+import heapq
+import itertools
+import random
+import selectors
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import client
+import message
+import peer
+import pieces
+import storage
+
+MAX_PEERS = 500 # connected and half-open peers across all of the torrents
+ANNOUNCE_WORKERS = 4 # tracker announces in flight at once
+START_WORKERS = 1 # torrents opening their files and rechecking at once
+ANNOUNCE_JITTER = 0.1 # announces are spread over this fraction of the tracker interval
+
+# Many torrents on one select loop and one listening port. A peer that connects to us is handed
+# to the torrent whose info_hash is in its handshake. The bandwidth limits, the half-open and
+# peer limits, the hashing and writer threads, the piece buffers, the read cache, the open files
+# and the wake up socket are shared by all of the torrents, and re-announces run a few at a time
+# on their own threads, spread out so they don't bunch up.
+# Each torrent is a Client driven through attach/prepare/handle_event/tick
+class Session():
+    def __init__(self, port = 6881, max_half_open = peer.MAX_HALF_OPEN, max_peers = MAX_PEERS, limits = None):
+        self.port = port
+        self.max_half_open = max_half_open
+        self.max_peers = max_peers
+        self.limits = limits or peer.RateLimits()
+        self.hashers = ThreadPoolExecutor(pieces.HASH_WORKERS)
+        self.buffers = pieces.BufferPool()
+        self.cache = pieces.ReadCache()
+        self.writer = ThreadPoolExecutor(1) # one thread, so each torrent's writes and fsyncs happen in order
+        self.open_files = storage.OpenFiles()
+        self.announcers = ThreadPoolExecutor(ANNOUNCE_WORKERS)
+        self.starters = ThreadPoolExecutor(START_WORKERS)
+        self.clients = {} # info_hash -> Client
+        self.starting = {} # info_hash -> Client added but still opening its files and rechecking
+        self.incoming = {} # sock -> [addr, MessageBuffer, deadline] of peers we're waiting on a handshake from
+        self.announces = [] # heap of (time, seq, client) of the next announce of each torrent
+        self.announce_seq = itertools.count() # tie breaker so the heap never compares clients
+        self.completions = storage.Completions() # announce results and torrents added from other threads
+        self.selector = None
+        self.wakeup = None
+        self.lock = threading.Lock() # add() can be called from other threads while the loop runs
+        self.running = False # the loop has started the torrents added before it, see add()
+
+    # Add a torrent, running or not. Takes the same arguments as Client. The torrent's first
+    # announce happens here, on the calling thread
+    def add(self, torrent, compact = 1, seeder = 0, **kwargs):
+        new_client = client.Client(torrent, compact, self.port, seeder, limits=self.limits, hashers=self.hashers,
+                                   buffers=self.buffers, cache=self.cache, writer=self.writer,
+                                   open_files=self.open_files, **kwargs)
+        info_hash = new_client.tracker.info_hash
+        with self.lock:
+            existing = self.clients.get(info_hash) or self.starting.get(info_hash)
+            if existing is not None:
+                print(f'{torrent} is already in the session')
+                return existing
+
+            # in starting straight away, so adding it again before the loop gets to it finds it
+            self.starting[info_hash] = new_client
+            if self.running:
+                # the loop thread starts it
+                self.completions.post(self.start_client, new_client)
+        return new_client
+
+    # Change the shared rate limits in bytes/s while running, see peer.RateLimits.set
+    def set_rate_limits(self, upload = None, download = None, peer_upload = None, peer_download = None):
+        self.limits.set(upload, download, peer_upload, peer_download)
+
+    # Open the torrent's files, load its resume file or recheck it on a starter thread, so a
+    # big recheck doesn't hold up the other torrents. It joins the loop in started()
+    def start_client(self, client_):
+        future = self.starters.submit(client_.start)
+        future.add_done_callback(lambda future: self.completions.post(self.started, client_, future))
+
+    def started(self, client_, future):
+        info_hash = client_.tracker.info_hash
+        try:
+            future.result()
+        except (Exception, SystemExit) as e:
+            print(f'{e!r}. could not start {client_.tracker.torrent_name}')
+            with self.lock:
+                del self.starting[info_hash]
+            return
+        with self.lock:
+            # never in neither, or add() could add it twice
+            self.clients[info_hash] = client_
+            del self.starting[info_hash]
+        client_.attach(self.selector, self.wake)
+        self.schedule_announce(client_)
+
+    # Put the torrent's next announce on the heap. The first one after startup is moved by up to
+    # ANNOUNCE_JITTER of the interval so torrents added together don't all announce together
+    def schedule_announce(self, client_, jitter = True):
+        if jitter:
+            client_.next_announce += random.uniform(0, ANNOUNCE_JITTER * client_.tracker.interval)
+        heapq.heappush(self.announces, (client_.next_announce, next(self.announce_seq), client_))
+
+    # Start the announces that are due on the announce threads
+    def announce(self, now):
+        while self.announces and self.announces[0][0] <= now:
+            _, _, client_ = heapq.heappop(self.announces)
+            if client_.tracker.info_hash not in self.clients:
+                continue
+            # nothing more to wait for until it's back
+            client_.next_announce = float('inf')
+            future = self.announcers.submit(client_.reannounce)
+            future.add_done_callback(lambda future, client_=client_: self.completions.post(self.announced, client_, future))
+
+    def announced(self, client_, future):
+        try:
+            new_peers = future.result()
+        except (Exception, SystemExit) as e:
+            # a bad tracker reply exit()s in tracker.send_http_req, that mustn't stop the session
+            print(f'{e!r}. announce failed for {client_.tracker.torrent_name}')
+            new_peers = []
+        if client_.tracker.info_hash not in self.clients:
+            return
+        client_.announced(new_peers)
+        self.schedule_announce(client_, jitter=False)
+
+    # runs on an announce thread, nothing is left to reschedule once a torrent is done
+    def announce_completed(self, client_):
+        try:
+            client_.tracker.get_peer_list(3)
+        except (Exception, SystemExit) as e:
+            print(f'{e!r}. completed announce failed for {client_.tracker.torrent_name}')
+
+    # called from the worker threads, gets select to return so the loop picks up their results
+    def wake(self):
+        try:
+            self.wakeup[1].send(b'\0')
+        except OSError:
+            # full means it's already awake, closed means the loop is gone
+            pass
+
+    # Start outbound connections for each torrent, within the half-open and peer limits shared
+    # by all of them
+    def start_connections(self):
+        half_open = sum(len(c.connector.half_open) for c in self.clients.values())
+        peers = sum(len(c.peers_manager) for c in self.clients.values()) + len(self.incoming)
+        for client_ in self.clients.values():
+            room = min(self.max_half_open - half_open, self.max_peers - peers - half_open)
+            if room <= 0:
+                break
+            if client_.connector.waiting:
+                half_open += client_.connector.start(room)
+
+    # A peer connected to us. It's ours until its handshake says which torrent it wants
+    def accept(self, new_sock, addr):
+        peers = sum(len(c.peers_manager) + len(c.connector.half_open) for c in self.clients.values())
+        if peers + len(self.incoming) >= self.max_peers:
+            print(f'too many peers, closing {addr}')
+            new_sock.close()
+            return
+
+        print(f"got new peer: {addr}")
+        new_sock.setblocking(0)
+        self.incoming[new_sock] = [addr, peer.MessageBuffer(), time.time() + peer.HANDSHAKE_TIMEOUT]
+        self.selector.register(new_sock, selectors.EVENT_READ, self)
+
+    def drop_incoming(self, sock, reason):
+        addr = self.incoming.pop(sock)[0]
+        print(f'{reason}. closing {addr}')
+        self.selector.unregister(sock)
+        sock.close()
+
+    # Read the handshake of a peer that connected to us and give it to its torrent
+    def on_handshake(self, sock):
+        addr, inbox, _ = self.incoming[sock]
+        try:
+            n = inbox.recv_into(sock)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.drop_incoming(sock, e)
+            return
+
+        if n == 0:
+            self.drop_incoming(sock, 'Peer closed connection')
+            return
+
+        data = inbox.take(68)
+        if data is None:
+            # wait for the rest of the handshake
+            return
+
+        handshake = message.Handshake.read_handshake(data)
+        client_ = self.clients.get(handshake.info_hash) if handshake is not None else None
+        if client_ is None:
+            self.drop_incoming(sock, 'No torrent for the handshake')
+            return
+
+        del self.incoming[sock]
+        self.selector.unregister(sock)
+        client_.adopt(sock, addr, inbox, data)
+
+    # drop the peers that connected but never sent a handshake
+    def expire_incoming(self, now):
+        for sock in [s for s, entry in self.incoming.items() if entry[2] <= now]:
+            self.drop_incoming(sock, 'handshake timed out')
+
+    # Every torrent's prepare(), returns how long select can wait
+    def prepare(self):
+        timeouts = [c.prepare() for c in self.clients.values()]
+        if self.announces:
+            timeouts.append(max(0, self.announces[0][0] - time.time()))
+        if self.incoming:
+            timeouts.append(max(0, min(entry[2] for entry in self.incoming.values()) - time.time()))
+        return min(timeouts) if timeouts else None
+
+    def run(self):
+        try:
+            self.run_select()
+        except KeyboardInterrupt:
+            # keep what we've got for next time
+            print("stopping, saving resume files")
+            for client_ in self.clients.values():
+                client_.pieces.save_resume(client_.tracker.info_hash, wait=True)
+                client_.pieces.close()
+
+    def run_select(self):
+        self.selector = selectors.DefaultSelector()
+
+        # the one port every torrent listens on
+        listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listen_sock.setblocking(0)
+        listen_sock.bind(("0.0.0.0", self.port))
+        listen_sock.listen()
+        self.selector.register(listen_sock, selectors.EVENT_READ, None)
+
+        # hash, write and announce results from the worker threads, for every torrent
+        self.wakeup = socket.socketpair()
+        for s in self.wakeup:
+            s.setblocking(0)
+        self.selector.register(self.wakeup[0], selectors.EVENT_READ, self.completions)
+        self.completions.wakeup = self.wake
+
+        with self.lock:
+            self.running = True
+            for client_ in list(self.starting.values()):
+                self.start_client(client_)
+
+        while self.clients or self.starting:
+            self.start_connections()
+            timeout = self.prepare()
+
+            for key, mask in self.selector.select(timeout):
+                sock = key.fileobj
+                if key.data is self.completions:
+                    # just a wake up, the results are picked up below
+                    try:
+                        sock.recv(4096)
+                    except BlockingIOError:
+                        pass
+
+                elif sock is listen_sock:
+                    self.accept(*sock.accept())
+
+                elif key.data is self:
+                    self.on_handshake(sock)
+
+                else:
+                    # a peer or a half-open connection of one of the torrents
+                    key.data.owner.handle_event(key, mask)
+
+            now = time.time()
+            self.completions.run()
+            self.expire_incoming(now)
+            for info_hash, client_ in list(self.clients.items()):
+                client_.tick(now)
+                if client_.is_done():
+                    client_.detach()
+                    del self.clients[info_hash]
+                    client_.finish(announce=False)
+                    self.announcers.submit(self.announce_completed, client_)
+            self.announce(now)
+
+        for sock in list(self.incoming):
+            self.drop_incoming(sock, 'session done')
+        self.selector.unregister(listen_sock)
+        listen_sock.close()
+        self.completions.wakeup = None
+        self.selector.unregister(self.wakeup[0])
+        for s in self.wakeup:
+            s.close()
+        self.selector.close()
+        # let the completed announces go out
+        self.announcers.shutdown(wait=True)
+
+        print("done.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='BitTorrent client for many torrents on one port')
+    parser.add_argument('torrents', nargs='+', help='paths to torrents')
+    parser.add_argument('--compact', type=int, choices=[0, 1], default=1, help='compact format (0 or 1)(default 1)')
+    parser.add_argument('--port', type=int, default=6881, help='port to listen on (default 6881)')
+    parser.add_argument('--seed', action='store_true', help='seed the torrents')
+    parser.add_argument('--half-open', type=int, default=peer.MAX_HALF_OPEN,
+                        help=f'outbound connections in flight at once, for all torrents (default {peer.MAX_HALF_OPEN})')
+    parser.add_argument('--max-peers', type=int, default=MAX_PEERS,
+                        help=f'peers connected at once, for all torrents (default {MAX_PEERS})')
+    parser.add_argument('--upload-limit', type=int, default=0,
+                        help='KB/s to upload at most, for all torrents, 0 for no limit (default 0)')
+    parser.add_argument('--download-limit', type=int, default=0,
+                        help='KB/s to download at most, for all torrents, 0 for no limit (default 0)')
+    args = parser.parse_args()
+
+    session = Session(args.port, args.half_open, args.max_peers,
+                      peer.RateLimits(args.upload_limit * 2**10, args.download_limit * 2**10))
+    for torrent in args.torrents:
+        session.add(torrent, args.compact, int(args.seed))
+    session.run()
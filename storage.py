@@ -0,0 +1,490 @@
+import bisect
+import mmap
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+WRITE_BACK_LEN = 2**24 # bytes of verified pieces held back to be written together
+WRITE_BACK_DELAY = 1 # seconds a piece may wait in the write-back queue
+SYNC_INTERVAL = 30 # seconds between fsyncs with the 'interval' policy
+MAX_IOV = 512 # most buffers handed to one pwritev call
+MAX_OPEN_FILES = 128 # files kept open at once, shared by the torrents of a Session
+
+# when to fsync the file
+SYNC_NONE = 'none' # leave it to the OS
+SYNC_CLOSE = 'close' # once, when the download is done
+SYNC_FLUSH = 'flush' # after every write-back flush
+SYNC_INTERVAL_POLICY = 'interval' # after a flush, at most every SYNC_INTERVAL seconds
+SYNC_POLICIES = [SYNC_NONE, SYNC_CLOSE, SYNC_FLUSH, SYNC_INTERVAL_POLICY]
+
+# Work finished on other threads, handed back to the event loop. A worker posts a function to
+# call and wakes the loop up, and the loop calls everything posted with run()
+class Completions():
+    def __init__(self) -> None:
+        self.queue = queue.SimpleQueue()
+        self.wakeup = None # set by the engine, called from the worker threads
+
+    def post(self, fn, *args):
+        self.queue.put((fn, args))
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def run(self):
+        while True:
+            try:
+                fn, args = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            fn(*args)
+
+# A range of one of the files queued in a peer's outbox in place of the data, for os.sendfile.
+# It holds on to the file and not its fd, which may have been closed by the time it's sent
+class FileRange():
+    def __init__(self, storage, index, offset, length) -> None:
+        self.storage = storage
+        self.index = index
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    # send what's left after the first sent bytes. Returns how much went out
+    def sendfile(self, sock, sent):
+        file = self.storage.use(self.index, create=False)
+        if file is None:
+            raise OSError(f'{self.storage.files.paths[self.index]} is gone')
+        try:
+            n = os.sendfile(sock.fileno(), file.fd, self.offset + sent, self.length - sent)
+        finally:
+            self.storage.open_files.release(file)
+        if n == 0:
+            raise OSError(f'file ended at {self.offset + sent}')
+        return n
+
+# An open file: its fd, the read-only mapping uploads are served from once there is one, and
+# how many calls are using the fd right now
+class OpenFile():
+    def __init__(self, fd) -> None:
+        self.fd = fd
+        self.map = None
+        self.users = 0
+        self.closing = False # closed as soon as the last user is done with it
+
+    def close(self):
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # blocks are still queued to go out, the mapping goes away with them
+                pass
+            self.map = None
+        os.close(self.fd)
+
+# The files open at once, least recently used closed first once there are more than max_open.
+# Files are only opened when they're first read or written, and a file in use is never closed
+# under whoever is using it: a call takes the file with acquire() and gives it back with
+# release() once it's done with the fd. A Session shares one between all of its torrents
+class OpenFiles():
+    def __init__(self, max_open = MAX_OPEN_FILES) -> None:
+        self.max_open = max_open
+        self.lock = threading.Lock() # files get opened from the loop, writer, hash and recheck threads
+        self.files = OrderedDict() # (storage, file index) -> OpenFile, most recently used last
+
+    # The OpenFile of a Storage's file i, opened (see Storage.open_fd) if it isn't already.
+    # None if it doesn't exist and create is off. Has to be released. Once the Storage is
+    # closed (a Stream can still be reading) the file is opened for the one call and closed
+    # again when it's released
+    def acquire(self, storage, i, create = True):
+        key = (storage, i)
+        with self.lock:
+            file = self.files.get(key)
+            if file is not None and not file.closing:
+                file.users += 1
+                self.files.move_to_end(key)
+                return file
+
+        # opening can mean allocating the whole file, so not while holding the lock
+        fd = storage.open_fd(i, create)
+        if fd is None:
+            return None
+        with self.lock:
+            if storage.closed:
+                file = OpenFile(fd)
+                file.closing = True
+                file.users = 1
+                return file
+            file = self.files.get(key)
+            if file is not None and not file.closing:
+                # opened by another thread in the meantime
+                os.close(fd)
+            else:
+                file = self.files[key] = OpenFile(fd)
+            file.users += 1
+            self.files.move_to_end(key)
+            if len(self.files) > self.max_open:
+                self.evict()
+        return file
+
+    def release(self, file):
+        with self.lock:
+            file.users -= 1
+            if file.closing and file.users == 0:
+                file.close()
+
+    # the read-only mapping of an acquired file, made the first time it's needed
+    def map(self, file, length):
+        with self.lock:
+            if file.map is None:
+                file.map = mmap.mmap(file.fd, length, access=mmap.ACCESS_READ)
+            return file.map
+
+    # close idle files, least recently used first, until there are max_open left. Holds the lock
+    def evict(self):
+        for key in list(self.files):
+            if len(self.files) <= self.max_open:
+                return
+            file = self.files[key]
+            if file.users == 0:
+                del self.files[key]
+                file.close()
+
+    # Close all of a Storage's files. One that's in use gets closed when it's released
+    def close(self, storage):
+        with self.lock:
+            for key in [key for key in self.files if key[0] is storage]:
+                file = self.files.pop(key)
+                file.closing = True
+                if file.users == 0:
+                    file.close()
+
+# Where each file of the torrent sits in the torrent's data (all the files one after another,
+# which is what the pieces are cut from). The start offsets are binary searched, so finding the
+# files a range covers doesn't depend on how many files there are
+class FileMap():
+    def __init__(self, files) -> None:
+        self.paths = [path for path, _ in files]
+        self.lengths = [length for _, length in files]
+        self.starts = []
+        offset = 0
+        for length in self.lengths:
+            self.starts.append(offset)
+            offset += length
+        self.size = offset
+
+    def __len__(self):
+        return len(self.paths)
+
+    # (file index, offset in the file, length) for each file a range of the data is in, in order
+    def spans(self, offset, length):
+        spans = []
+        end = min(offset + length, self.size)
+        i = max(0, bisect.bisect_right(self.starts, offset) - 1)
+        while offset < end:
+            n = min(end, self.starts[i] + self.lengths[i]) - offset
+            if n > 0:
+                spans.append((i, offset - self.starts[i], n))
+                offset += n
+            i += 1
+        return spans
+
+# The files being downloaded. Their fds come from an OpenFiles, which opens them when they're
+# needed and keeps only so many open, and everything goes through pread/pwrite at absolute
+# offsets, split up by the FileMap where a range crosses from one file to the next. Verified
+# pieces wait in a write-back queue, and when it's flushed pieces next to each other go out as
+# one sequential pwritev per file on the writer thread, so the event loop never waits on the disk.
+# A Session hands all of its torrents the same OpenFiles and writer thread
+class Storage():
+    def __init__(self, files, preallocate = False, sync = SYNC_CLOSE, sendfile = False,
+                 completions = None, writer = None, open_files = None) -> None:
+        self.files = FileMap(files) # [(path, length)] in torrent order
+        self.size = self.files.size
+        self.preallocate = preallocate
+        self.sync = sync
+        self.sendfile = sendfile and hasattr(os, 'sendfile')
+        self.open_files = open_files or OpenFiles()
+        # files we want. the others only get created if a piece we want runs into them
+        self.selected = set(range(len(self.files)))
+        self.unsynced = set() # files written to since the last fsync
+        self.closed = False
+        self.pending = {} # offset -> (data, callback once it's on disk)
+        self.writing = {} # same, for what's been handed to the writer thread
+        self.writer = writer or ThreadPoolExecutor(1) # one thread, so writes and fsyncs happen in order
+        self.last_write = None # future of the last batch handed to the writer
+        self.completions = completions # where finished writes are reported, None to wait for them
+        self.pending_len = 0
+        self.oldest = None # when the oldest pending write was queued
+        self.last_sync = time.time()
+
+    # Create the files we want that aren't there yet, each given its full size up front. They're
+    # opened again when they're used
+    def open(self):
+        for i in sorted(self.selected):
+            self.open_files.release(self.use(i))
+
+    # The OpenFile of file i, to be given back with open_files.release once the fd isn't needed
+    # any more. None if it doesn't exist and create is off
+    def use(self, i, create = True):
+        return self.open_files.acquire(self, i, create)
+
+    # Open file i for the OpenFiles. A new file is created (unless create is off) with its full
+    # size, either by really allocating the blocks or as a sparse file. An existing file is
+    # left as it is. None if it doesn't exist and create is off
+    def open_fd(self, i, create = True):
+        path = self.files.paths[i]
+        length = self.files.lengths[i]
+        if not create and not os.path.isfile(path):
+            return None
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(fd).st_size < length:
+            self.allocate(fd, path, length)
+        return fd
+
+    def allocate(self, fd, path, length):
+        if self.preallocate and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, length)
+                return
+            except OSError as e:
+                # e.g. the filesystem doesn't support it
+                print(f'{e}. could not preallocate {path}, using a sparse file')
+        os.ftruncate(fd, length)
+
+    # Queue data to be written at offset. done() is called once it's been written
+    def write(self, offset, data, done = None):
+        if self.oldest is None:
+            self.oldest = time.time()
+        self.pending[offset] = (data, done)
+        self.pending_len += len(data)
+        if self.pending_len >= WRITE_BACK_LEN:
+            self.flush()
+
+    # seconds until the write-back queue is due to be flushed, None if it's empty
+    def timeout(self):
+        if self.oldest is None:
+            return None
+        return max(0, self.oldest + WRITE_BACK_DELAY - time.time())
+
+    # Flush the write-back queue if it's been waiting long enough. Called from the event loops
+    def tick(self, now):
+        if self.oldest is not None and now - self.oldest >= WRITE_BACK_DELAY:
+            self.flush()
+
+    # Hand everything queued to the writer thread. The done() callbacks are posted back through
+    # completions once it's written. With wait (or no completions) it's written before returning
+    def flush(self, wait = False):
+        if not self.pending:
+            if wait and self.last_write is not None:
+                self.last_write.result()
+            return
+
+        batch = self.pending
+        self.pending = {}
+        self.pending_len = 0
+        self.oldest = None
+        # still readable from memory until the writer is done with it
+        self.writing.update(batch)
+
+        self.last_write = self.writer.submit(self._write_batch, batch)
+        if wait or self.completions is None:
+            self._written(batch, self.last_write)
+        else:
+            self.last_write.add_done_callback(lambda future: self.completions.post(self._written, batch, future))
+
+    # Run fn on the writer thread once everything queued so far is written. done(future) is
+    # posted back through completions once it's run. With wait (or no completions) it's called
+    # before returning
+    def submit(self, fn, done, wait = False):
+        self.flush(wait)
+        self.last_write = self.writer.submit(fn)
+        if wait or self.completions is None:
+            done(self.last_write)
+        else:
+            future = self.last_write
+            future.add_done_callback(lambda future: self.completions.post(done, future))
+
+    # Runs on the writer thread. Sorts the batch and writes runs of adjacent data in one call each
+    def _write_batch(self, batch):
+        run_start = run_end = None
+        run = []
+        for offset in sorted(batch):
+            data = batch[offset][0]
+            if run and (offset != run_end or len(run) == MAX_IOV):
+                self._write_run(run_start, run)
+                run = []
+            if not run:
+                run_start = run_end = offset
+            run.append(data)
+            run_end += len(data)
+        self._write_run(run_start, run)
+
+        if self.sync == SYNC_FLUSH or (self.sync == SYNC_INTERVAL_POLICY and time.time() - self.last_sync >= SYNC_INTERVAL):
+            self.fsync()
+
+    # Back on the loop once a batch is on disk
+    def _written(self, batch, future):
+        # raises here if the write failed
+        future.result()
+        for offset, (_, done) in batch.items():
+            self.writing.pop(offset, None)
+            if done is not None:
+                done()
+
+    # Write a run of adjacent buffers starting at offset of the torrent's data, one pwritev per
+    # file it covers
+    def _write_run(self, offset, bufs):
+        bufs = [memoryview(data) for data in bufs]
+        for i, file_offset, length in self.files.spans(offset, sum(len(buf) for buf in bufs)):
+            # the buffers, or parts of them, that go in this file
+            part = []
+            while length > 0:
+                if len(bufs[0]) <= length:
+                    buf = bufs.pop(0)
+                else:
+                    buf = bufs[0][:length]
+                    bufs[0] = bufs[0][length:]
+                part.append(buf)
+                length -= len(buf)
+            file = self.use(i)
+            try:
+                self._pwritev(file.fd, file_offset, part)
+            finally:
+                self.open_files.release(file)
+            self.unsynced.add(i)
+
+    def _pwritev(self, fd, offset, bufs):
+        if not hasattr(os, 'pwritev'):
+            for data in bufs:
+                self._pwrite(fd, offset, data)
+                offset += len(data)
+            return
+
+        while bufs:
+            written = os.pwritev(fd, bufs, offset)
+            offset += written
+            # drop what went out, a short write leaves the rest for the next call
+            while bufs and written >= len(bufs[0]):
+                written -= len(bufs[0])
+                bufs.pop(0)
+            if bufs and written:
+                bufs[0] = bufs[0][written:]
+
+    def _pwrite(self, fd, offset, data):
+        data = memoryview(data)
+        while data:
+            written = os.pwrite(fd, data, offset)
+            offset += written
+            data = data[written:]
+
+    # Read from the files without copying: a memoryview into the file's mapping, which stays
+    # valid after the file is closed. Data that isn't on disk yet is copied, its buffer gets
+    # reused once it's written. So is a range that runs from one file into the next
+    def read(self, offset, length):
+        for queued in (self.pending, self.writing):
+            for start, (data, _) in queued.items():
+                if start <= offset and offset + length <= start + len(data):
+                    return bytes(data[offset - start:offset - start + length])
+
+        spans = self.files.spans(offset, length)
+        if len(spans) == 1:
+            i, file_offset, n = spans[0]
+            file = self.use(i, create=False)
+            if file is not None:
+                try:
+                    # the file has its final size, so one mapping covers everything we'll ever
+                    # serve from it. pwrites show up in it straight away, it's the same page cache
+                    return memoryview(self.open_files.map(file, self.files.lengths[i]))[file_offset:file_offset + n]
+                finally:
+                    self.open_files.release(file)
+        return self.pread(offset, length)
+
+    # Plain read from the files, a copy the caller owns (for hashing on another thread).
+    # Short if a file is missing or shorter than it should be
+    def pread(self, offset, length):
+        parts = []
+        for i, file_offset, n in self.files.spans(offset, length):
+            file = self.use(i, create=False)
+            if file is None:
+                break
+            try:
+                data = os.pread(file.fd, n, file_offset)
+            finally:
+                self.open_files.release(file)
+            parts.append(data)
+            if len(data) < n:
+                break
+        return b''.join(parts)
+
+    # Write right away, past the write-back queue
+    def write_now(self, offset, data):
+        data = memoryview(data)
+        for i, file_offset, n in self.files.spans(offset, len(data)):
+            file = self.use(i)
+            try:
+                self._pwrite(file.fd, file_offset, data[:n])
+            finally:
+                self.open_files.release(file)
+            self.unsynced.add(i)
+            data = data[n:]
+
+    # [size, mtime in ns] of each file, [] for the ones that don't exist
+    def fingerprint(self):
+        fingerprint = []
+        for path in self.files.paths:
+            try:
+                stat = os.stat(path)
+                fingerprint.append([stat.st_size, stat.st_mtime_ns])
+            except FileNotFoundError:
+                fingerprint.append([])
+        return fingerprint
+
+    # how many of the files we want are there already
+    def files_on_disk(self):
+        return sum(os.path.isfile(self.files.paths[i]) for i in self.selected)
+
+    # A FileRange for sendfile, None if sendfile is off, the data isn't on disk yet or it
+    # crosses into another file
+    def file_range(self, offset, length):
+        if not self.sendfile:
+            return None
+        spans = self.files.spans(offset, length)
+        if len(spans) != 1:
+            return None
+        for queued in (self.pending, self.writing):
+            for start, (data, _) in queued.items():
+                if start < offset + length and offset < start + len(data):
+                    return None
+        return FileRange(self, spans[0][0], spans[0][1], length)
+
+    # Sync the files written to since the last fsync. A file that's been closed since is
+    # opened again, syncing any fd of a file syncs all of it
+    def fsync(self):
+        for i in sorted(self.unsynced):
+            self.unsynced.discard(i)
+            file = self.use(i, create=False)
+            if file is None:
+                continue
+            try:
+                if hasattr(os, 'fdatasync'):
+                    os.fdatasync(file.fd)
+                else:
+                    os.fsync(file.fd)
+            finally:
+                self.open_files.release(file)
+        self.last_sync = time.time()
+
+    def close(self):
+        self.flush(wait=True)
+        if self.sync != SYNC_NONE:
+            self.fsync()
+        # files in use, by a Stream reading on another thread say, are closed once they're
+        # done with them, and from now on every call opens and closes its own fd
+        self.closed = True
+        self.open_files.close(self)
@@ -4,6 +4,7 @@ import random
 import string
 import struct
 import math
+import os
 from urllib.parse import urlparse, quote
 from hashlib import sha1
 
@@ -21,8 +22,13 @@ class Tracker():
         self.torrent_creation_date = torrent[b'creation date'] if b'creation date' in torrent else 0
         self.torrent_encoding = torrent[b'encoding'] if b'encoding' in torrent else ''
         # Keys in the Info dict
-        self.torrent_name = torrent[b'info'][b'name']
-        self.torrent_length = torrent[b'info'][b'length']
+        self.torrent_name = safe_name(torrent[b'info'][b'name'])
+        if b'files' in torrent[b'info']:
+            # multi-file torrent, the name is the directory they go in
+            self.torrent_files = [(file_path(self.torrent_name, f[b'path']), f[b'length']) for f in torrent[b'info'][b'files']]
+        else:
+            self.torrent_files = [(self.torrent_name, torrent[b'info'][b'length'])]
+        self.torrent_length = sum(length for _, length in self.torrent_files)
         self.torrent_piece_length = torrent[b'info'][b'piece length']
         self.torrent_pieces_hash = torrent[b'info'][b'pieces']
         print(self.torrent_piece_length)
@@ -78,6 +84,19 @@ class Tracker():
             self.peer_list = [(resp[b'peers'][i][b'ip'].decode(), resp[b'peers'][i][b'port'],
                                resp[b'peers'][i][b'peer id'].decode()) for i in range(0, len(resp[b'peers']))]
 
+# Where a file of a multi-file torrent goes. Path components that would lead outside the
+# torrent's directory are left out
+def file_path(name, path):
+    parts = [p for p in path if p not in (b'', b'.', b'..') and b'/' not in p and b'\\' not in p]
+    return os.path.join(name, *parts)
+
+# The torrent's name as one file or directory name in the current directory. A name like
+# b'/etc' or b'../x' would lead somewhere else, so the separators and the components that
+# go up or nowhere are left out
+def safe_name(name):
+    parts = [p for p in name.replace(b'\\', b'/').split(b'/') if p not in (b'', b'.', b'..')]
+    return b'_'.join(parts) or b'torrent'
+
 # Open and parse torrent file 
 def parse_torrent(torrent):
     try: